@@ -0,0 +1,120 @@
+"""
+Check src/arxiv2csv.py against the converter it replaced
+
+Zips the JSON-lines fixture (a few snapshot records with multi-line
+titles, LaTeX, quotes, commas, CRLF, missing fields and an empty version
+history), converts it with the old get_arxiv.sh pipeline (split, jq, vim,
+jq) and with arxiv2csv, and checks that both produce the same shards with
+the same rows. The two differences made on purpose are applied before
+comparing: the old vim pass replaced every backslash-n in the JSON text,
+so it also ate the \\n of LaTeX macros such as \\nabla, and it kept CRs,
+which arxiv2csv replaces with spaces. A second arxiv2csv run must leave
+every shard unchanged.
+
+The old pipeline needs bash, unzip, split, jq and vim on the PATH.
+
+Usage (from the repository root):
+    python -m benchmarks.converter
+    python -m benchmarks.converter --maxlines 2 --snapshot ./raw/sample.json
+"""
+import re
+import subprocess
+import tempfile
+from argparse import ArgumentParser
+from glob import glob
+from os import makedirs
+from os.path import basename, dirname, join
+from zipfile import ZIP_DEFLATED, ZipFile
+import pandas as pd
+from src import arxiv2csv as ARXIV2CSV
+
+FIXTURE = join(dirname(__file__), 'fixtures',
+               'arxiv-metadata-oai-snapshot.json')
+MAXLINES = 3
+OLD_CONVERTER = r'''
+set -e
+unzip -p "$1" > "$2/arxiv.json"
+split -l "$3" -a 3 -d "$2/arxiv.json" "$4/ARXIV_S"
+echo "id,authors,title,comments,journal_ref,doi,report_no,categories,abstract,version_num,version_created,last_update" > "$2/columns"
+for SLICE in "$4"/ARXIV_S*; do
+	jq '{id,authors,title,comments,"journal-ref",doi,"report-no",categories,abstract,"version":.versions[-1].version,"created":.versions[-1].created,update_date}' "$SLICE" > "$2/temp"
+	vim -es -c '%s/\\\+n/ /g' -cwq "$2/temp"
+	jq -r '[.[]] | @csv' "$2/temp" > "$SLICE"
+	cat "$2/columns" "$SLICE" > "$2/temp"
+	mv "$2/temp" "$SLICE"
+done
+'''
+
+
+def old_convert(archive: str, idir: str, maxlines: int, workdir: str):
+    """Shards as the old get_arxiv.sh wrote them"""
+    subprocess.run(['bash', '-c', OLD_CONVERTER, 'get_arxiv', archive,
+                    workdir, str(maxlines), idir], check=True)
+
+
+def read_shard(filename: str) -> pd.DataFrame:
+    return pd.read_csv(filename, dtype=str, keep_default_na=False)
+
+
+def old_cleaning(value: str) -> str:
+    """What the old vim substitution made of text arxiv2csv keeps"""
+    return re.sub(r'\\+n', ' ', value)
+
+
+def apply_cells(df: pd.DataFrame, fn) -> pd.DataFrame:
+    """DataFrame.map, named applymap before pandas 2.1"""
+    return (df.map if hasattr(df, 'map') else df.applymap)(fn)
+
+
+def check(snapshot: str, maxlines: int) -> bool:
+    """Convert snapshot with both converters and compare the shards
+
+    Returns:
+        bool: Whether every shard matched and a rerun changed nothing
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = join(tmp, 'arxiv.zip')
+        with ZipFile(archive, 'w', ZIP_DEFLATED) as z:
+            z.write(snapshot, basename(snapshot))
+        old_dir, new_dir = join(tmp, 'old'), join(tmp, 'new')
+        makedirs(old_dir)
+        makedirs(new_dir)
+        old_convert(archive, old_dir, maxlines, tmp)
+        shards, _ = ARXIV2CSV.convert(archive, new_dir, maxlines, workers=1)
+        old_shards = sorted(basename(fn) for fn in glob(join(old_dir, '*')))
+        new_shards = sorted(basename(fn) for fn in glob(join(new_dir, '*')))
+        same = old_shards == new_shards
+        print(f'shards: old {old_shards}, new {new_shards}')
+        for name in old_shards:
+            if name not in new_shards:
+                continue
+            old = read_shard(join(old_dir, name))
+            new = read_shard(join(new_dir, name))
+            kept = apply_cells(new, lambda v: v != old_cleaning(v)).to_numpy()
+            new = apply_cells(new, old_cleaning)
+            old = old.replace('\r', ' ', regex=True)
+            ok = old.shape == new.shape and (old.to_numpy()
+                                             == new.to_numpy()).all()
+            same &= bool(ok)
+            print(f'{name}: {len(new)} rows {"match" if ok else "MISMATCH"} '
+                  f'({kept.sum()} fields keep a backslash-n the old '
+                  f'converter dropped)')
+            if not ok and old.shape == new.shape:
+                for row, column in zip(*(old.to_numpy()
+                                         != new.to_numpy()).nonzero()):
+                    print(f'   row {row} {old.columns[column]}: '
+                          f'{old.iat[row, column]!r} != '
+                          f'{new.iat[row, column]!r}')
+        _, changed = ARXIV2CSV.convert(archive, new_dir, maxlines, workers=1)
+        print(f'rerun: {changed} of {shards} shards rewritten')
+        return same and changed == 0
+
+
+if __name__ == "__main__":
+    p = ArgumentParser()
+    p.add_argument('--snapshot', default=FIXTURE,
+                   help='JSON-lines snapshot to convert (default: fixture)')
+    p.add_argument('--maxlines', default=MAXLINES, type=int,
+                   help='Papers per shard')
+    args = p.parse_args()
+    raise SystemExit(0 if check(args.snapshot, args.maxlines) else 1)
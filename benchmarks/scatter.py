@@ -0,0 +1,128 @@
+"""
+Scatter-gather check for partition workers
+
+Starts N partition workers on localhost (the same code path as
+`python main.py --serve HOST:PORT --part I/N`), sends random prompt
+vectors through the coordinator with and without filters, and checks
+that the merged top k matches a single-process search of the whole
+index. Reports the latency of both.
+
+Usage (from the repository root):
+    python -m benchmarks.scatter --workers 4
+    python -m benchmarks.scatter --workers 2 8 --scale 100k
+    python -m benchmarks.scatter --workers 4 --index ./index
+"""
+import socket
+from argparse import ArgumentParser
+from multiprocessing import get_context
+from os.path import join
+from statistics import median
+from time import perf_counter, sleep
+import numpy as np
+from benchmarks import suite as SUITE
+from src import index as INDEX
+from src import server as SERVER
+from src import sota_search as SOTA
+
+FILTERS = [{},
+           {'since': '2020'},
+           {'categories': ['cs', 'stat.ML']},
+           {'since': '2015-06-01', 'feeds': ['ARXIV']}]
+PROMPTS = 8
+K = 10
+STARTUP_SECONDS = 60
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def run_worker(embeddings_fn: str, part: int, parts: int, address: str):
+    experiment = SOTA.Experiment('', embeddings_fn, K)
+    experiment.load()
+    experiment.rows = INDEX.split_rows(len(experiment.metadata), parts, part)
+    SERVER.serve(experiment, address)
+
+
+def wait_for(address: str):
+    host, port = SERVER.parse_address(address)
+    deadline = perf_counter() + STARTUP_SECONDS
+    while True:
+        try:
+            socket.create_connection((host, port)).close()
+            return
+        except OSError:
+            if perf_counter() > deadline:
+                raise
+            sleep(0.1)
+
+
+def check(embeddings_fn: str, parts: int, repeat: int) -> bool:
+    """Compare a scatter-gather search on parts workers with one process
+
+    Returns:
+        bool: Whether every prompt and filter gave the same top k
+    """
+    addresses = [f'localhost:{free_port()}' for _ in range(parts)]
+    context = get_context('spawn')
+    workers = [context.Process(target=run_worker, daemon=True,
+                               args=(embeddings_fn, part, parts, address))
+               for part, address in enumerate(addresses)]
+    for worker in workers:
+        worker.start()
+    try:
+        for address in addresses:
+            wait_for(address)
+        single = SOTA.Experiment('', embeddings_fn, K)
+        single.load()
+        rng = np.random.default_rng(SUITE.SEED)
+        vectors = INDEX.normalize(rng.standard_normal(
+            (PROMPTS, single.embeddings.shape[1]), dtype=np.float32))
+        same = True
+        for filters in FILTERS:
+            local, remote = [], []
+            for _ in range(repeat):
+                tic = perf_counter()
+                expected = single.search_vectors(vectors, K, filters)
+                local.append(perf_counter() - tic)
+                tic = perf_counter()
+                merged = SOTA.gather(
+                    SERVER.scatter(addresses, vectors, K, filters), K)
+                remote.append(perf_counter() - tic)
+            ok = all(list(a.index) == list(b.index) and
+                     np.allclose(a.similarity, b.similarity)
+                     for a, b in zip(expected, merged))
+            same &= ok
+            print(f'{parts} workers {str(filters):<45} '
+                  f'{"match" if ok else "MISMATCH"}  single '
+                  f'{1000*median(local):7.1f}ms  scatter '
+                  f'{1000*median(remote):7.1f}ms')
+        return same
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
+
+if __name__ == "__main__":
+    p = ArgumentParser()
+    p.add_argument('--workers', nargs='+', default=[4], type=int,
+                   help='Numbers of partition workers to check')
+    p.add_argument('--index',
+                   help='Index directory to use instead of a synthetic one')
+    p.add_argument('--scale', default='10k',
+                   help='Size of the synthetic corpus, e.g. 100k')
+    p.add_argument('--workdir', default=SUITE.WORKDIR,
+                   help='Where synthetic corpora are generated and kept')
+    p.add_argument('--repeat', default=3, type=int)
+    args = p.parse_args()
+    idir = args.index
+    if idir is None:
+        idir = join(args.workdir, args.scale)
+        SUITE.build_corpus(idir, SUITE.parse_scale(args.scale))
+    embeddings_fn = INDEX.embeddings_path(idir)
+    results = [check(embeddings_fn, parts, args.repeat)
+               for parts in args.workers]
+    raise SystemExit(0 if all(results) else 1)
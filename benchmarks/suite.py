@@ -0,0 +1,292 @@
+"""
+Offline benchmark suite for Dr. Draft's SOTA Literature Search
+
+Generates a synthetic corpus (ARXIV-format shards, a random normalized
+embedding matrix, metadata and records) at each requested scale and times
+the stages of a search: read_narrative_embeddings, load_model,
+encode_prompt, sort_by_similarity_to_prompt, select_results (from
+records.sqlite and from raw shards) and results2csv. Every scale runs in
+its own process, so its peak RSS is not inflated by the previous one.
+
+Usage (from the repository root):
+    python -m benchmarks.suite --scales 10k 100k -o bench.json
+    python -m benchmarks.suite --scales 1M 2.5M --random-prompts -o bench.json
+    python -m benchmarks.suite --compare main.json branch.json
+
+Corpora are cached under --workdir and reused by later runs.
+"""
+import contextlib
+import io
+import json
+import platform
+import resource
+import subprocess
+from argparse import ArgumentParser
+from multiprocessing import get_context
+from os import devnull, makedirs, remove
+from os.path import exists, join
+from statistics import median
+from time import perf_counter, strftime
+import numpy as np
+import pandas as pd
+from src import data as DATA
+from src import index as INDEX
+from src import records as RECORDS
+
+WORKDIR = './bench_index'
+SCALES = ['10k', '100k', '1M', '2.5M']
+DIMS = 768  # all-mpnet-base-v2
+ROWS_PER_SHARD = 10000
+REPEAT = 5
+K = 10
+SEED = 0
+COLUMNS = ['id', 'authors', 'title', 'comments', 'journal_ref', 'doi',
+           'report_no', 'categories', 'abstract', 'version_num',
+           'version_created', 'last_update']
+CATEGORIES = ['cs.LG stat.ML', 'cs.CL', 'cs.CV', 'math.PR', 'hep-th',
+              'astro-ph.GA', 'q-bio.NC', 'eess.SP', 'stat.ME', 'quant-ph']
+WORDS = ('model learning data neural network method results show propose '
+         'approach problem paper performance based training algorithm '
+         'framework analysis deep language image graph optimization '
+         'inference theory quantum field energy galaxy protein signal '
+         'estimation').split()
+PROMPT = ('We propose to research new methods for verification and '
+          'validation of artificial intelligence and machine learning '
+          'models fit to data.')
+
+
+def parse_scale(scale: str) -> int:
+    """'10k' -> 10000, '2.5M' -> 2500000"""
+    units = {'k': 10**3, 'm': 10**6}
+    unit = scale[-1].lower()
+    if unit in units:
+        return int(float(scale[:-1])*units[unit])
+    return int(scale)
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far (Linux: KiB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+
+def write_shards(idir: str, rows: int, rng) -> list:
+    """ARXIV_S000 shards of synthetic papers, ROWS_PER_SHARD rows each"""
+    shards = []
+    for number, start in enumerate(range(0, rows, ROWS_PER_SHARD)):
+        n = min(ROWS_PER_SHARD, rows - start)
+        ids = [f'{2000 + i//100000:04d}.{i % 100000:05d}'
+               for i in range(start, start + n)]
+        lengths = rng.integers(80, 250, n)
+        words = rng.integers(0, len(WORDS), lengths.sum())
+        cuts = np.cumsum(lengths)[:-1]
+        abstracts = [' '.join(WORDS[w] for w in chunk)
+                     for chunk in np.split(words, cuts)]
+        years = rng.integers(2007, 2025, n)
+        df = pd.DataFrame({
+            'id': ids,
+            'authors': 'A. Author, B. Author',
+            'title': [' '.join(a.split()[:8]).title() for a in abstracts],
+            'comments': '', 'journal_ref': None, 'doi': '', 'report_no': '',
+            'categories': rng.choice(CATEGORIES, n),
+            'abstract': abstracts, 'version_num': 'v1',
+            'version_created': [f'Mon, 2 Apr {y} 19:18:42 GMT' for y in years],
+            'last_update': [f'{y}-11-13' for y in years]})
+        fn = join(idir, f'ARXIV_S{number:03d}')
+        df[COLUMNS].to_csv(fn, index=False)
+        shards.append(fn)
+    return shards
+
+
+def build_corpus(idir: str, rows: int, dims=DIMS):
+    """Synthetic index directory with rows narratives, reused if present
+
+    Args:
+        idir (str): Directory for the shards and index files
+        rows (int): Number of narratives
+        dims (int, optional): Embedding width. Defaults to DIMS.
+    """
+    embeddings_fn = INDEX.embeddings_path(idir)
+    if exists(RECORDS.records_path(embeddings_fn)):
+        return
+    makedirs(idir, exist_ok=True)
+    rng = np.random.default_rng(SEED)
+    shards = write_shards(idir, rows, rng)
+    out = np.lib.format.open_memmap(embeddings_fn, mode='w+',
+                                    dtype=np.float32, shape=(rows, dims))
+    for start in range(0, rows, INDEX.BLOCK):
+        block = rng.standard_normal((min(INDEX.BLOCK, rows - start), dims),
+                                    dtype=np.float32)
+        out[start:start+len(block)] = INDEX.normalize(block)
+    out.flush()
+    del out
+    metadata, records = [], []
+    for fn in shards:
+        obj = DATA.ARXIV(fn, 'abstract')
+        df = obj.get_descriptions()
+        df['posted'] = obj.get_posted().to_numpy()
+        df['categories'] = obj.get_categories().to_numpy()
+        metadata.append(df)
+        records.append(obj)
+    metadata = pd.concat(metadata, ignore_index=True)
+    INDEX.write_metadata(INDEX.metadata_path(embeddings_fn), metadata)
+
+    def iter_records():
+        i = 0
+        for obj in records:
+            for row in range(len(obj.df)):
+                record = obj.to_dict(row, None)
+                del record['Similarity']
+                yield i, record
+                i += 1
+    RECORDS.write_records(RECORDS.records_path(embeddings_fn), iter_records())
+
+
+def timed(fn, repeat=REPEAT):
+    """Run fn repeat times
+
+    Returns:
+        Tuple[dict, Any]: seconds of every run with their median and
+            min, and the last return value
+    """
+    seconds = []
+    for _ in range(repeat):
+        tic = perf_counter()
+        value = fn()
+        seconds.append(perf_counter() - tic)
+    return {'seconds': seconds, 'median': median(seconds),
+            'min': min(seconds)}, value
+
+
+def run_scale(scale: str, workdir: str, dims: int, repeat: int,
+              random_prompts: bool) -> dict:
+    """Time every stage on one synthetic corpus, in a fresh process
+
+    Returns:
+        dict: rows, stages (timings and peak RSS after each), peak RSS
+    """
+    from src import sota_search as SOTA
+    rows = parse_scale(scale)
+    idir = join(workdir, scale)
+    tic = perf_counter()
+    build_corpus(idir, rows, dims)
+    result = {'rows': rows, 'dims': dims, 'stages': {},
+              'generate_seconds': perf_counter() - tic}
+    stages = result['stages']
+
+    def record(name, timing):
+        stages[name] = {**timing, 'peak_rss_mb': peak_rss_mb()}
+
+    embeddings_fn = INDEX.embeddings_path(idir)
+    timing, (metadata, embeddings) = timed(
+        lambda: SOTA.read_narrative_embeddings(embeddings_fn), repeat)
+    record('read_narrative_embeddings', timing)
+    if random_prompts:
+        rng = np.random.default_rng(SEED)
+        SOTA.encode_prompts = lambda prompts: rng.standard_normal(
+            (len(prompts), dims), dtype=np.float32)
+        stages['load_model'] = stages['encode_prompt'] = {'skipped':
+                                                          'random prompts'}
+    else:
+        timing, _ = timed(SOTA.load_model, 1)
+        record('load_model', timing)
+        timing, _ = timed(lambda: SOTA.encode_prompt(PROMPT), repeat)
+        record('encode_prompt', timing)
+    timing, neighbors = timed(
+        lambda: SOTA.sort_by_similarity_to_prompt(PROMPT, embeddings, K),
+        repeat)
+    record('sort_by_similarity_to_prompt', timing)
+
+    experiment = SOTA.Experiment(PROMPT, embeddings_fn, K)
+    with contextlib.redirect_stdout(io.StringIO()):
+        experiment.load()
+    experiment.nearest_neighbors = neighbors
+    timing, results = timed(lambda: experiment.select_results(range(K)),
+                            repeat)
+    record('select_results', timing)
+    experiment.records = None  # hydrate by parsing the raw shards
+
+    def from_shards():
+        experiment.shards.clear()
+        return experiment.select_results(range(K))
+    timing, _ = timed(from_shards, repeat)
+    record('select_results_shards', timing)
+
+    output_fn = join(idir, 'results.csv')
+
+    def to_csv():
+        if exists(output_fn):
+            remove(output_fn)
+        with open(devnull, 'w') as f, contextlib.redirect_stdout(f):
+            SOTA.results2csv(results.copy(), output_fn, PROMPT, 'bench')
+    timing, _ = timed(to_csv, repeat)
+    record('results2csv', timing)
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(old_fn: str, new_fn: str):
+    """Print the median time of every stage in two runs and their ratio"""
+    with open(old_fn) as f:
+        old = json.load(f)
+    with open(new_fn) as f:
+        new = json.load(f)
+    print(f'{"scale":<6} {"stage":<30} {old["commit"]:>10} '
+          f'{new["commit"]:>10}  ratio')
+    for scale, run in new['scales'].items():
+        before = old['scales'].get(scale, {}).get('stages', {})
+        for stage, timing in run['stages'].items():
+            if 'median' not in timing or 'median' not in before.get(stage, {}):
+                continue
+            a, b = before[stage]['median'], timing['median']
+            flag = '  <-- slower' if b > 1.1*a else ''
+            print(f'{scale:<6} {stage:<30} {1000*a:9.2f}ms {1000*b:9.2f}ms '
+                  f'{b/a if a else float("inf"):6.2f}{flag}')
+        if scale in old['scales']:
+            print(f'{scale:<6} {"peak RSS":<30} '
+                  f'{old["scales"][scale]["peak_rss_mb"]:8.0f}MB '
+                  f'{run["peak_rss_mb"]:8.0f}MB')
+
+
+if __name__ == "__main__":
+    p = ArgumentParser()
+    p.add_argument('--scales', nargs='+', default=SCALES[:2],
+                   help=f'Corpus sizes, e.g. {" ".join(SCALES)}')
+    p.add_argument('--dims', default=DIMS, type=int)
+    p.add_argument('--repeat', default=REPEAT, type=int,
+                   help='Runs of each stage; the median is reported')
+    p.add_argument('--workdir', default=WORKDIR,
+                   help='Where synthetic corpora are generated and kept')
+    p.add_argument('--random-prompts', action='store_true',
+                   help='Score random prompt vectors instead of loading the '
+                        'sentence transformer')
+    p.add_argument('-o', '--output', help='JSON file for the results')
+    p.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                   help='Compare two JSON results instead of running')
+    args = p.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        raise SystemExit
+    report = {'commit': git_commit(), 'date': strftime('%Y-%m-%d %H:%M:%S'),
+              'python': platform.python_version(), 'numpy': np.__version__,
+              'pandas': pd.__version__, 'machine': platform.machine(),
+              'k': K, 'scales': {}}
+    for scale in args.scales:
+        with get_context('spawn').Pool(1) as pool:
+            run = pool.apply(run_scale, (scale, args.workdir, args.dims,
+                                         args.repeat, args.random_prompts))
+        report['scales'][scale] = run
+        print(f'{scale}: ' + ', '.join(
+            f'{name} {1000*t["median"]:.1f}ms' for name, t
+            in run['stages'].items() if 'median' in t)
+            + f'; peak RSS {run["peak_rss_mb"]:.0f} MB')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
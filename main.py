@@ -6,20 +6,56 @@ Command-line Arguments:
     - `-k, --k`: Number of matches to return (default: 3)
     - `-o, --output`: CSV file to store output
     - `-t, --title`: Title for results if multiple queries (default: 'CLI prompt')
+    - `--serve [ADDRESS]`: Keep the model and index loaded and answer queries
+      on a Unix socket path or host:port (default: ./index/drdraft.sock)
+    - `--connect [ADDRESS]`: Send the query to a running `--serve` process
+    - `--part I/N`: With --serve, answer as the partition worker for the
+      I-th of N slices of the index (0/4 ... 3/4)
+    - `--workers ADDRESS [ADDRESS ...]`: Scatter the search to these
+      partition workers and merge their top k; the workers run this
+      --search mode (exact, ann or quantized), --nprobe and --rerank
+    - `-b, --batch`: CSV/JSONL file of (title, prompt, k) queries to run at once
+    - `--timing-startup`: Print a summary of import time by package at exit
+    - `--profile [TRACE]`: Print wall time, CPU time and peak RSS of every
+      search stage at exit and write them as JSON (default: profile.json)
+    - `--chrome-trace FILE`: With --profile, also write a Chrome trace
+    - `--no-query-cache`: Encode and search again even if this prompt was
+      searched before against the same index (cache: index/query_cache.sqlite)
+    - `--search`: exact scan, approximate (ann) IVF search, scan of
+      compressed (quantized) codes with re-ranking, BM25 (lexical) ranking,
+      dense scoring of BM25 candidates only (prefilter), or rank fusion of
+      BM25 and exact scores (hybrid) (default: exact)
+    - `--nprobe`: IVF lists scanned per prompt with --search ann (default: 16)
+    - `--rerank`: Shortlist rerank*k for --search quantized (default: 20)
+    - `--since`: Only papers posted on or after this date, e.g. 2021-06-01
+    - `--category`: Only these arXiv categories or archives, e.g. cs.LG stat
+    - `--feed`: Only these sources, e.g. ARXIV NSF
+    - `--scope`: Only scan these partitions of an index built with
+      --partition: primary categories (cs.LG), archives (cs) or feeds (NSF)
 
 Usage:
     python main.py [-p PROMPT] [-k K] [-a] [-o OUTPUT] [-t TITLE] [-i] [-s]
 
 Example:
     python main.py -p "Research on climate change" -k 5 -o results.csv -t "Climate Change Research"
+    python main.py --serve &
+    python main.py --connect -p "Research on climate change" -k 5
+    python main.py --serve localhost:9000 --part 0/2 &
+    python main.py --serve localhost:9001 --part 1/2 &
+    python main.py --workers localhost:9000 localhost:9001 -p "Research on climate change"
+    python main.py -b portfolio.csv -o results.csv
+    python main.py -p "Research on climate change" --since 2022 --category cs stat.ML
 """
+import atexit
 import faulthandler
 from argparse import ArgumentParser
 from warnings import filterwarnings
-from src import sota_search
 
 IDIR = './index'
-EMBEDDINGS = f'{IDIR}'+'/embeddings.pkl'
+PROFILE = 'profile.json'
+EMBEDDINGS = f'{IDIR}'+'/embeddings.npy'
+SOCKET = f'{IDIR}'+'/drdraft.sock'
+QUERY_CACHE = f'{IDIR}'+'/query_cache.sqlite'
 
 if __name__ == "__main__":
     faulthandler.enable()
@@ -28,32 +64,121 @@ if __name__ == "__main__":
     p.add_argument('-p', '--prompt', default='CLI',
                    help='Description of the work you want to do')
     p.add_argument('-k', '--k', default=3, type=int,
-                   help='Restrict search to arXiv papers submitted within last s(int) years.')
+                   help='Number of matches to return')
     p.add_argument('-o', '--output',
                    help='CSV file to store output')
     p.add_argument('-t', '--title', default='CLI prompt',
                    help='Title for results if multiple queries')
+    p.add_argument('--serve', nargs='?', const=SOCKET, metavar='ADDRESS',
+                   help='Keep the index loaded and answer queries on ADDRESS')
+    p.add_argument('--connect', nargs='?', const=SOCKET, metavar='ADDRESS',
+                   help='Send the query to a running --serve process')
+    p.add_argument('--part', metavar='I/N',
+                   help='With --serve, serve only the I-th of N slices of '
+                        'the index as a partition worker')
+    p.add_argument('--workers', nargs='+', metavar='ADDRESS',
+                   help='Scatter the search to these partition workers')
+    p.add_argument('-b', '--batch',
+                   help='CSV/JSONL file of (title, prompt, k) queries')
+    p.add_argument('--timing-startup', action='store_true',
+                   help='Print a summary of import time by package at exit')
+    p.add_argument('--profile', nargs='?', const=PROFILE, metavar='TRACE',
+                   help='Time every search stage and write a JSON trace')
+    p.add_argument('--chrome-trace', metavar='FILE',
+                   help='With --profile, also write a Chrome trace')
+    p.add_argument('--no-query-cache', action='store_true',
+                   help='Ignore prompt vectors and results cached by earlier '
+                        'searches of the same index')
+    p.add_argument('--search', default='exact',
+                   choices=['exact', 'ann', 'quantized', 'lexical',
+                            'prefilter', 'hybrid'],
+                   help='Exact scan, approximate IVF search, compressed '
+                        'codes, BM25, BM25 candidates dense-scored, or BM25 '
+                        'and dense ranks fused (build with '
+                        'compute_embeddings.py --ivf-lists/--quantize/'
+                        '--lexical)')
+    p.add_argument('--nprobe', default=16, type=int,
+                   help='IVF lists scanned per prompt with --search ann')
+    p.add_argument('--rerank', default=20, type=int,
+                   help='Re-rank rerank*k full-precision rows with '
+                        '--search quantized')
+    p.add_argument('--since', metavar='DATE',
+                   help='Only papers posted on or after DATE (e.g. 2021 or '
+                        '2021-06-01)')
+    p.add_argument('--category', nargs='+', metavar='CAT',
+                   help='Only papers in any of these categories, e.g. '
+                        'cs.LG, or archives, e.g. cs')
+    p.add_argument('--feed', nargs='+', metavar='FEED',
+                   help='Only narratives from these sources, e.g. ARXIV')
+    p.add_argument('--scope', nargs='+', metavar='PARTITION',
+                   help='Only scan these partitions (primary category, '
+                        'archive or feed) of an index built with --partition')
     args = p.parse_args()
+    filters = {'since': args.since, 'categories': args.category,
+               'feeds': args.feed, 'scope': args.scope}
+
+    # Heavy imports (pandas, numpy, torch) wait until arguments are valid
+    if args.timing_startup:
+        from src import startup
+        timer = startup.ImportTimer()
+        timer.install()
+        atexit.register(timer.report)
+    if args.profile:
+        from src import tracing
+        tracing.profile(args.profile, args.chrome_trace)
+    from src import sota_search
+    from src import server
+    from src import index
+
+    experiment = sota_search.Experiment(args.prompt, EMBEDDINGS, args.k,
+                                        search=args.search,
+                                        nprobe=args.nprobe,
+                                        rerank=args.rerank,
+                                        filters=filters,
+                                        workers=args.workers,
+                                        query_cache=None
+                                        if args.no_query_cache or args.part
+                                        else QUERY_CACHE)
+    if args.serve:
+        experiment.load()
+        if args.part:  # receives encoded prompts; no model needed
+            part, parts = (int(x) for x in args.part.split('/'))
+            experiment.rows = index.split_rows(len(experiment.metadata),
+                                               parts, part)
+            print(f' - Partition {part}/{parts}: rows '
+                  f'{experiment.rows[0]}-{experiment.rows[1]}')
+        else:
+            sota_search.load_model()
+        server.serve(experiment, args.serve)
+        raise SystemExit
+
+    if args.batch:
+        queries = sota_search.read_prompts(args.batch, args.k, args.title)
+        batch = experiment.query_batch(list(queries.prompt), queries.k)
+        for query, results in zip(queries.itertuples(), batch):
+            if not args.output:
+                sota_search.results2console(results)
+            else:
+                sota_search.results2csv(results, args.output,
+                                        query.prompt, query.title)
+        raise SystemExit
 
     sota_search.show_flags(args.k,
                               args.prompt,
                               args.output,
-                              args.title
+                              args.title,
+                              filters
                               )
 
-    experiment = sota_search.Experiment(args.prompt, EMBEDDINGS, args.k)
-    experiment.run()
-    results = experiment.select_results(range(args.k))
-    if len(results)<args.k:
-        results = experiment.select_results(range(10*args.k))
-
-    results.drop_duplicates(subset=['Title'],
-                            keep='first',
-                            inplace=True,
-                            ignore_index=True
-                            )
-    if not args.output:
-        sota_search.results2console(results.iloc[:args.k])
+    if args.connect:
+        results = server.query(args.connect, args.prompt, args.k, filters)
     else:
-        sota_search.results2csv(results.iloc[:args.k], args.output, args.prompt, args.title)
+        experiment.run()
+        results = experiment.results()
+    with sota_search.TRACE.stage('output'):
+        if not args.output:
+            sota_search.results2console(results)
+        else:
+            sota_search.results2csv(results, args.output, args.prompt,
+                                    args.title)
 
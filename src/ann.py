@@ -0,0 +1,492 @@
+"""
+Approximate nearest-neighbor search over the embedding matrix.
+
+An inverted file (IVF) index clusters the L2-normalized narratives with
+spherical k-means. A query scores the coarse centroids, then only the
+narratives in its `nprobe` closest lists, so work per query is roughly
+nprobe/n_lists of an exact scan.
+
+Quantized codes (int8 per dimension, or product quantization with 256
+centroids per subspace) are a compact copy of the matrix. A query scores
+every code, then re-ranks a shortlist of rerank*k narratives with the
+full-precision rows read from the memory map.
+
+The same lists bound the search for near-duplicate narratives at index
+build: only pairs within a list are compared.
+
+Run as a module to report recall@k of the IVF index and quantized codes
+against the exact scan of `sota_search` (from the repository root):
+    python -m src.ann ./index -k 10 --nprobe 1 4 16 64
+"""
+from argparse import ArgumentParser
+from functools import partial
+from os import remove
+from os.path import dirname, exists, join
+from time import perf_counter
+import numpy as np
+try:
+    from src import index as INDEX
+except ImportError:  # run from src/, as compute_embeddings.py and the CLI are
+    import index as INDEX
+
+IVF = 'ivf.npz'
+CODES = 'codes.npy'
+QUANTIZER = 'quantizer.npz'
+QUANTIZERS = ('int8', 'pq')
+NPROBE = 16
+RERANK = 20  # shortlist rerank*k narratives scored with full precision
+PQ_SUBSPACES = 96  # 8 dims and one byte per subspace for 768-d vectors
+PQ_CLUSTERS = 256
+TRAIN_SAMPLE = 100000  # k-means is trained on a sample of the corpus
+TRAIN_ITERATIONS = 10
+BLOCK = 65536  # rows per block when assigning the whole corpus to lists
+DUPLICATE_THRESHOLD = 0.98  # cosine above which narratives are duplicates
+PAIR_BLOCK = 4096  # rows of a list compared with the whole list at once
+
+
+def ivf_path(embeddings_fn: str) -> str:
+    """The IVF index always lives next to the embedding matrix"""
+    return join(dirname(embeddings_fn), IVF)
+
+
+def codes_path(embeddings_fn: str) -> str:
+    return join(dirname(embeddings_fn), CODES)
+
+
+def quantizer_path(embeddings_fn: str) -> str:
+    return join(dirname(embeddings_fn), QUANTIZER)
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return x / norms
+
+
+def assign_lists(embs: np.ndarray, centroids: np.ndarray,
+                 spherical=True) -> np.ndarray:
+    """Closest centroid of every row, scanning the matrix in blocks
+
+    Args:
+        embs (np.ndarray): #narratives x #dims vectors
+        centroids (np.ndarray): #lists x #dims centroids
+        spherical (bool, optional): Closest by cosine (normalized inputs)
+            rather than by L2 distance. Defaults to True.
+
+    Returns:
+        np.ndarray: List number of every narrative
+    """
+    bias = 0 if spherical else -0.5*(centroids**2).sum(axis=1)
+    assign = np.empty(len(embs), dtype=np.int32)
+    for start in range(0, len(embs), BLOCK):
+        block = np.asarray(embs[start:start+BLOCK], dtype=np.float32)
+        assign[start:start+BLOCK] = (block.dot(centroids.T)
+                                     + bias).argmax(axis=1)
+    return assign
+
+
+def kmeans(train: np.ndarray, n_clusters: int, spherical=True,
+           seed=0) -> np.ndarray:
+    """Lloyd's k-means, spherical for normalized narratives
+
+    Args:
+        train (np.ndarray): #samples x #dims float32 vectors
+        n_clusters (int): Number of clusters
+        spherical (bool, optional): Keep centroids unit length.
+            Defaults to True.
+        seed (int, optional): Defaults to 0.
+
+    Returns:
+        np.ndarray: #clusters x #dims float32 centroids
+    """
+    rng = np.random.default_rng(seed)
+    centroids = train[rng.choice(len(train), n_clusters,
+                                 replace=len(train) < n_clusters)]
+    for _ in range(TRAIN_ITERATIONS):
+        assign = assign_lists(train, centroids, spherical)
+        counts = np.bincount(assign, minlength=n_clusters)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        filled = counts > 0  # empty clusters keep their previous centroid
+        members = train[np.argsort(assign, kind='stable')]
+        sums = np.add.reduceat(members, starts[filled], axis=0)
+        if spherical:
+            centroids[filled] = sums
+            centroids = _normalize(centroids)
+        else:
+            centroids[filled] = sums / counts[filled, None]
+    return centroids.astype(np.float32)
+
+
+def _sample(embs: np.ndarray, n: int, seed=0, order=None) -> np.ndarray:
+    """A float32 copy of n random rows, read in file order
+
+    With order (a permutation of the rows), the sample and its row order
+    are drawn from that permutation instead of the file order.
+    """
+    rng = np.random.default_rng(seed)
+    picks = np.sort(rng.choice(len(embs), min(len(embs), n), replace=False))
+    if order is None:
+        return np.asarray(embs[picks], dtype=np.float32)
+    rows = np.asarray(order)[picks]
+    by_row = np.argsort(rows)
+    sample = np.empty((len(rows), embs.shape[1]), dtype=np.float32)
+    sample[by_row] = embs[rows[by_row]]  # read in file order
+    return sample
+
+
+def train_centroids(embs: np.ndarray, n_lists: int, seed=0,
+                    order=None) -> np.ndarray:
+    """Spherical k-means on a sample of the corpus
+
+    Args:
+        embs (np.ndarray): #narratives x #dims normalized vectors
+        n_lists (int): Number of coarse clusters
+        seed (int, optional): Defaults to 0.
+        order (np.ndarray, optional): Rows in an order that does not
+            depend on the file layout, to sample from. Defaults to none.
+
+    Returns:
+        np.ndarray: #lists x #dims normalized float32 centroids
+    """
+    train = _sample(embs, max(TRAIN_SAMPLE, n_lists), seed, order)
+    return kmeans(train, n_lists, spherical=True, seed=seed)
+
+
+def build_ivf(embs: np.ndarray, n_lists: int, seed=0, order=None) -> dict:
+    """Cluster the corpus into an inverted file index
+
+    Args:
+        embs (np.ndarray): #narratives x #dims normalized vectors
+        n_lists (int): Number of lists, e.g. 4*sqrt(#narratives)
+        seed (int, optional): Defaults to 0.
+        order (np.ndarray, optional): As in `train_centroids`
+
+    Returns:
+        dict: centroids, ids (narratives ordered by list) and offsets
+            (where each list starts in ids)
+    """
+    centroids = train_centroids(embs, n_lists, seed, order)
+    assign = assign_lists(embs, centroids)
+    counts = np.bincount(assign, minlength=n_lists)
+    return {'centroids': centroids,
+            'ids': np.argsort(assign, kind='stable').astype(np.int64),
+            'offsets': np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+            }
+
+
+def write_ivf(filename: str, ivf: dict):
+    np.savez(filename, **ivf)
+
+
+def read_ivf(filename: str, n_rows: int = None) -> dict:
+    """Read an IVF index, checking it lists every row of the matrix
+
+    Args:
+        filename (str): From ivf_path
+        n_rows (int, optional): Rows in the matrix the index must cover
+
+    Raises:
+        ValueError: The index was built for another matrix
+    """
+    with np.load(filename) as f:
+        ivf = {key: f[key] for key in f.files}
+    if n_rows is not None and len(ivf['ids']) != n_rows:
+        raise ValueError(f'{filename} lists {len(ivf["ids"])} rows but the '
+                         f'matrix has {n_rows}; rebuild it with '
+                         f'src/compute_embeddings.py --ivf-lists')
+    return ivf
+
+
+def remove_ivf(filename: str):
+    """Drop an IVF index whose row ids no longer match the matrix"""
+    if exists(filename):
+        remove(filename)
+
+
+def near_duplicates(embs: np.ndarray, threshold=DUPLICATE_THRESHOLD,
+                    n_lists=None, seed=0, order=None) -> np.ndarray:
+    """Pairs of narratives at least threshold similar, compared only
+    within the IVF list both fall in
+
+    The search is approximate: a pair split across two lists is missed.
+    With order, the lists (and so the misses) are the same whatever the
+    order of the shards.
+
+    Args:
+        embs (np.ndarray): #narratives x #dims normalized vectors
+        threshold (float, optional): Minimum cosine similarity
+        n_lists (int, optional): Lists to split the corpus into.
+            Defaults to sqrt(#narratives).
+        seed (int, optional): Defaults to 0.
+        order (np.ndarray, optional): Rows sorted by a key of their
+            content, e.g. the description digest
+
+    Returns:
+        np.ndarray: #pairs x 2 row ids, smaller id first
+    """
+    if len(embs) < 2:
+        return np.empty((0, 2), dtype=np.int64)
+    ivf = build_ivf(embs, n_lists or int(np.sqrt(len(embs))), seed, order)
+    offsets = ivf['offsets']
+    pairs = []
+    for p in range(len(offsets) - 1):
+        ids = np.sort(ivf['ids'][offsets[p]:offsets[p+1]])
+        vectors = np.asarray(embs[ids], dtype=np.float32)
+        for start in range(0, len(ids), PAIR_BLOCK):
+            sims = vectors[start:start+PAIR_BLOCK].dot(vectors.T)
+            i, j = np.nonzero(sims >= threshold)
+            upper = start + i < j
+            pairs.append(np.stack([ids[start + i[upper]], ids[j[upper]]],
+                                  axis=1))
+    return np.concatenate(pairs) if pairs \
+        else np.empty((0, 2), dtype=np.int64)
+
+
+def search(ivf: dict, embs: np.ndarray, query: np.ndarray, k: int,
+           nprobe=NPROBE, mask=None):
+    """Approximate top k narratives for one normalized query
+
+    With a mask, only allowed narratives are scored, and lists beyond the
+    nprobe nearest are scanned until k of them are found.
+
+    Args:
+        ivf (dict): Index from `build_ivf`/`read_ivf`
+        embs (np.ndarray): #narratives x #dims normalized vectors
+        query (np.ndarray): #dims normalized vector
+        k (int): Number of narratives to return
+        nprobe (int, optional): Lists to scan. Defaults to NPROBE.
+        mask (np.ndarray, optional): Boolean mask of allowed narratives
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: ids and similarities, best first
+    """
+    offsets = ivf['offsets']
+    lists = ivf['centroids'].dot(query)
+    probe = INDEX.top_k(lists, nprobe if mask is None else len(lists))
+    chosen, found = [], 0
+    for i, p in enumerate(probe):
+        ids = ivf['ids'][offsets[p]:offsets[p+1]]
+        if mask is not None:
+            ids = ids[mask[ids]]
+        chosen.append(ids)
+        found += len(ids)
+        if i + 1 >= nprobe and found >= k:
+            break
+    ids = np.sort(np.concatenate(chosen))
+    scores = np.asarray(embs[ids], dtype=np.float32).dot(query)
+    best = INDEX.top_k(scores, k)
+    return ids[best], scores[best]
+
+
+def train_quantizer(embs: np.ndarray, kind: str,
+                    subspaces=PQ_SUBSPACES, seed=0) -> dict:
+    """Fit int8 scales or product-quantization codebooks
+
+    Args:
+        embs (np.ndarray): #narratives x #dims normalized vectors
+        kind (str): 'int8' or 'pq'
+        subspaces (int, optional): PQ subspaces; must divide #dims
+        seed (int, optional): Defaults to 0.
+
+    Returns:
+        dict: kind plus scale (int8) or codebooks (pq,
+            #subspaces x 256 x #dims/#subspaces)
+    """
+    if kind == 'int8':
+        peak = np.zeros(embs.shape[1], dtype=np.float32)
+        for start in range(0, len(embs), BLOCK):
+            block = np.abs(np.asarray(embs[start:start+BLOCK]))
+            peak = np.maximum(peak, block.max(axis=0))
+        peak[peak == 0] = 1
+        return {'kind': np.array(kind), 'scale': peak/127}
+    dims = embs.shape[1]
+    if dims % subspaces:
+        raise ValueError(f'{subspaces} PQ subspaces do not divide {dims} dims')
+    train = _sample(embs, TRAIN_SAMPLE, seed)
+    width = dims//subspaces
+    codebooks = np.stack([kmeans(train[:, j*width:(j+1)*width], PQ_CLUSTERS,
+                                 spherical=False, seed=seed+j)
+                          for j in range(subspaces)])
+    return {'kind': np.array(kind), 'codebooks': codebooks}
+
+
+def encode(quantizer: dict, embs: np.ndarray) -> np.ndarray:
+    """Compress a block of vectors to int8 or uint8 PQ codes"""
+    embs = np.asarray(embs, dtype=np.float32)
+    if str(quantizer['kind']) == 'int8':
+        return np.clip(np.rint(embs/quantizer['scale']),
+                       -127, 127).astype(np.int8)
+    codebooks = quantizer['codebooks']
+    width = codebooks.shape[2]
+    return np.stack([assign_lists(embs[:, j*width:(j+1)*width], cb,
+                                  spherical=False)
+                     for j, cb in enumerate(codebooks)],
+                    axis=1).astype(np.uint8)
+
+
+def write_codes(filename: str, quantizer: dict, embs: np.ndarray):
+    """Encode the whole matrix block by block into a .npy file"""
+    first = encode(quantizer, embs[:1])
+    codes = np.lib.format.open_memmap(filename, mode='w+', dtype=first.dtype,
+                                      shape=(len(embs), first.shape[1]))
+    for start in range(0, len(embs), BLOCK):
+        codes[start:start+BLOCK] = encode(quantizer, embs[start:start+BLOCK])
+    codes.flush()
+    del codes
+
+
+def write_quantizer(filename: str, quantizer: dict):
+    np.savez(filename, **quantizer)
+
+
+def read_quantizer(filename: str) -> dict:
+    with np.load(filename) as f:
+        return {key: f[key] for key in f.files}
+
+
+def read_codes(filename: str, n_rows: int = None) -> np.ndarray:
+    """Memory-map quantized codes, checking they cover every row
+
+    Args:
+        filename (str): From codes_path
+        n_rows (int, optional): Rows in the matrix the codes must cover
+
+    Raises:
+        ValueError: The codes were written for another matrix
+    """
+    codes = np.load(filename, mmap_mode='r')
+    if n_rows is not None and len(codes) != n_rows:
+        raise ValueError(f'{filename} has {len(codes)} codes but the matrix '
+                         f'has {n_rows} rows; rebuild it with '
+                         f'src/compute_embeddings.py --quantize')
+    return codes
+
+
+def remove_quantized(embeddings_fn: str):
+    """Drop codes and quantizer that no longer match the matrix"""
+    for fn in (codes_path(embeddings_fn), quantizer_path(embeddings_fn)):
+        if exists(fn):
+            remove(fn)
+
+
+def quantized_scores(quantizer: dict, codes: np.ndarray,
+                     query: np.ndarray) -> np.ndarray:
+    """Approximate similarity of every code to one normalized query"""
+    scores = np.empty(len(codes), dtype=np.float32)
+    if str(quantizer['kind']) == 'int8':
+        scaled = (query*quantizer['scale']).astype(np.float32)
+        for start in range(0, len(codes), BLOCK):
+            block = np.asarray(codes[start:start+BLOCK], dtype=np.float32)
+            scores[start:start+BLOCK] = block.dot(scaled)
+        return scores
+    codebooks = quantizer['codebooks']
+    width = codebooks.shape[2]
+    table = np.einsum('jcw,jw->jc', codebooks,
+                      query.reshape(len(codebooks), width))
+    subspace = np.arange(len(codebooks))
+    for start in range(0, len(codes), BLOCK):
+        block = np.asarray(codes[start:start+BLOCK])
+        scores[start:start+BLOCK] = table[subspace, block].sum(axis=1)
+    return scores
+
+
+def search_quantized(quantizer: dict, codes: np.ndarray, embs: np.ndarray,
+                     query: np.ndarray, k: int, rerank=RERANK, mask=None):
+    """Top k by compressed codes, re-ranked with full-precision vectors
+
+    Args:
+        quantizer (dict): From `train_quantizer`/`read_quantizer`
+        codes (np.ndarray): #narratives x code bytes
+        embs (np.ndarray): #narratives x #dims normalized vectors, memmap
+        query (np.ndarray): #dims normalized vector
+        k (int): Number of narratives to return
+        rerank (int, optional): Shortlist size as a multiple of k
+        mask (np.ndarray, optional): Boolean mask of allowed narratives
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: ids and similarities, best first
+    """
+    scores = quantized_scores(quantizer, codes, query)
+    if mask is not None:
+        scores[~mask] = -np.inf
+    shortlist = np.sort(INDEX.top_k(scores, rerank*k))
+    if mask is not None:
+        shortlist = shortlist[mask[shortlist]]
+    scores = np.asarray(embs[shortlist], dtype=np.float32).dot(query)
+    best = INDEX.top_k(scores, k)
+    return shortlist[best], scores[best]
+
+
+def footprint(quantizer: dict, codes: np.ndarray) -> int:
+    """Bytes that must stay resident to score compressed codes"""
+    return codes.nbytes + sum(v.nbytes for v in quantizer.values())
+
+
+def sample_queries(embs: np.ndarray, n: int, noise=0.5, seed=0):
+    """Perturbed corpus vectors that stand in for encoded prompts"""
+    rng = np.random.default_rng(seed)
+    picks = np.asarray(embs[np.sort(rng.choice(len(embs), n, replace=False))],
+                       dtype=np.float32)
+    jitter = rng.normal(scale=noise/np.sqrt(embs.shape[1]), size=picks.shape)
+    return _normalize(picks + jitter.astype(np.float32))
+
+
+def recall_report(queries, k, exact, searches):
+    """Print recall@k and latency of approximate searches
+
+    Args:
+        queries (np.ndarray): #queries x #dims normalized vectors
+        k (int): Number of neighbors compared
+        exact (Callable): exact(queries, k) -> top k row ids of every
+            query, the ground truth
+        searches (Dict[str, Callable]): name -> search(query, k) that
+            returns (ids, similarities)
+    """
+    tic = perf_counter()
+    truth = [set(ids) for ids in exact(queries, k)]
+    exact_ms = 1000*(perf_counter() - tic)/len(queries)
+    print(f'{"exact":<16} {exact_ms:8.2f} ms/query  recall@{k} 1.0000')
+    for name, search_fn in searches.items():
+        tic = perf_counter()
+        found = [search_fn(q, k)[0] for q in queries]
+        ms = 1000*(perf_counter() - tic)/len(queries)
+        recall = np.mean([len(t.intersection(f))/len(t)
+                          for t, f in zip(truth, found)])
+        print(f'{name:<16} {ms:8.2f} ms/query  recall@{k} {recall:.4f}')
+
+
+if __name__ == "__main__":
+    p = ArgumentParser()
+    p.add_argument('IDIR', help='Index directory with embeddings.npy and '
+                                'ivf.npz and/or codes.npy, quantizer.npz')
+    p.add_argument('-k', '--k', default=10, type=int)
+    p.add_argument('--queries', default=100, type=int,
+                   help='Number of perturbed corpus vectors used as queries')
+    p.add_argument('--nprobe', default=[1, 4, 16, 64], type=int, nargs='+')
+    p.add_argument('--rerank', default=[1, 5, RERANK], type=int, nargs='+')
+    args = p.parse_args()
+    embeddings_fn = join(args.IDIR, 'embeddings.npy')
+    embs = np.load(embeddings_fn, mmap_mode='r')
+    searches = {}
+    if exists(ivf_path(embeddings_fn)):
+        ivf = read_ivf(ivf_path(embeddings_fn), len(embs))
+        for nprobe in args.nprobe:
+            searches[f'ivf nprobe={nprobe}'] = \
+                partial(search, ivf, embs, nprobe=nprobe)
+    if exists(quantizer_path(embeddings_fn)):
+        quantizer = read_quantizer(quantizer_path(embeddings_fn))
+        codes = read_codes(codes_path(embeddings_fn), len(embs))
+        print(f'{quantizer["kind"]} codes: {footprint(quantizer, codes)/2**20:.1f} MiB'
+              f' resident vs {embs.nbytes/2**20:.1f} MiB full precision')
+        for rerank in args.rerank:
+            searches[f'{quantizer["kind"]} rerank={rerank}'] = \
+                partial(search_quantized, quantizer, codes, embs,
+                        rerank=rerank)
+    from src import sota_search as SOTA  # imports this module
+
+    def exact(queries, k):
+        """The blocked exact scan searches run, in bounded memory"""
+        return [hits.index.to_numpy() for hits
+                in SOTA.sort_by_similarity_to_vectors(queries, embs, k)]
+    recall_report(sample_queries(embs, args.queries), args.k, exact,
+                  searches)
@@ -0,0 +1,161 @@
+"""
+Convert the Kaggle arXiv snapshot into ARXIV_S000 shards in one pass.
+
+The zip member (one JSON paper per line) is streamed without unpacking it.
+Every MAXLINES papers become one shard; worker processes extract the
+fields `data.ARXIV` reads, replace newlines in the text with spaces, and
+write the CSV. A shard whose content did not change is not rewritten, so
+incremental index builds and Parquet copies of it stay valid.
+
+Usage:
+    python src/arxiv2csv.py ./raw/arxiv.zip ./index --maxlines 10000
+"""
+import csv
+import io
+import json
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from multiprocessing import cpu_count
+from os import remove
+from os.path import exists, join
+from zipfile import ZipFile
+from tqdm import tqdm
+
+OUTFNAME = 'ARXIV_S'
+MAXLINES = 10000
+COLUMNS = ['id', 'authors', 'title', 'comments', 'journal_ref', 'doi',
+           'report_no', 'categories', 'abstract', 'version_num',
+           'version_created', 'last_update']
+
+
+def clean(value):
+    """Text on one line, as the CSV shards expect"""
+    if isinstance(value, str):
+        return value.replace('\r', ' ').replace('\n', ' ')
+    return value
+
+
+def paper2row(paper: dict) -> list:
+    """Extract the shard columns from one snapshot record
+
+    Args:
+        paper (dict): One parsed line of the snapshot
+
+    Returns:
+        list: Values in COLUMNS order
+    """
+    versions = paper.get('versions') or [{}]
+    return [clean(v) for v in (paper.get('id'),
+                               paper.get('authors'),
+                               paper.get('title'),
+                               paper.get('comments'),
+                               paper.get('journal-ref'),
+                               paper.get('doi'),
+                               paper.get('report-no'),
+                               paper.get('categories'),
+                               paper.get('abstract'),
+                               versions[-1].get('version'),
+                               versions[-1].get('created'),
+                               paper.get('update_date'))]
+
+
+def shard_path(idir: str, number: int) -> str:
+    return join(idir, f'{OUTFNAME}{number:03d}')
+
+
+def write_shard(idir: str, number: int, lines: list) -> bool:
+    """Convert snapshot lines to one CSV shard
+
+    Args:
+        idir (str): Index directory
+        number (int): Shard number
+        lines (list): Raw JSON lines of the shard's papers
+
+    Returns:
+        bool: Whether the shard file changed
+    """
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(COLUMNS)
+    writer.writerows(paper2row(json.loads(line)) for line in lines)
+    content = out.getvalue().encode()
+    fn = shard_path(idir, number)
+    if exists(fn):
+        with open(fn, 'rb') as f:
+            if f.read() == content:
+                return False
+    with open(fn, 'wb') as f:
+        f.write(content)
+    return True
+
+
+def read_slices(archive: str, maxlines: int):
+    """Stream the snapshot in slices of maxlines lines
+
+    Args:
+        archive (str): Kaggle zip with one JSON file
+        maxlines (int): Papers per shard
+
+    Yields:
+        list: Raw JSON lines
+    """
+    with ZipFile(archive) as z:
+        member = z.namelist()[0]
+        with z.open(member) as f:
+            lines = []
+            for line in io.TextIOWrapper(f, encoding='utf-8'):
+                if line.strip():
+                    lines.append(line)
+                if len(lines) == maxlines:
+                    yield lines
+                    lines = []
+            if lines:
+                yield lines
+
+
+def convert(archive: str, idir: str, maxlines=MAXLINES, workers=None):
+    """Write every slice of the snapshot as an ARXIV_S000 shard
+
+    Args:
+        archive (str): Kaggle zip with one JSON file
+        idir (str): Index directory
+        maxlines (int, optional): Papers per shard. Defaults to MAXLINES.
+        workers (int, optional): Converter processes. Defaults to all cores.
+
+    Returns:
+        Tuple[int, int]: Shards written and shards that changed
+    """
+    workers = workers or cpu_count()
+    changed = 0
+    shards = 0
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for lines in tqdm(read_slices(archive, maxlines), unit='shards',
+                          desc='Parsing JSON'):
+            pending.append(pool.submit(write_shard, idir, shards, lines))
+            shards += 1
+            if len(pending) > 2*workers:  # bound slices held in memory
+                changed += pending.popleft().result()
+        while pending:
+            changed += pending.popleft().result()
+    for fn in glob(join(idir, f'{OUTFNAME}*')):
+        suffix = fn[len(join(idir, OUTFNAME)):]
+        if suffix.isdigit() and int(suffix) >= shards:
+            remove(fn)  # left over from a larger snapshot
+    return shards, changed
+
+
+if __name__ == "__main__":
+    p = ArgumentParser()
+    p.add_argument('archive', help='Kaggle arXiv snapshot zip')
+    p.add_argument('IDIR', help='Index directory for ARXIV_S000 shards')
+    p.add_argument('--maxlines', default=MAXLINES, type=int,
+                   help='Papers per shard')
+    p.add_argument('--workers', type=int,
+                   help='Converter processes (default: all cores)')
+    args = p.parse_args()
+    shards, changed = convert(args.archive, args.IDIR, args.maxlines,
+                              args.workers)
+    print(f'{shards} shards, {changed} new or changed')
@@ -0,0 +1,203 @@
+"""
+Persistent, content-addressed caches of embeddings and search results.
+
+Description vectors are keyed by (model name, hash of the
+whitespace-normalized description), so an abstract that reappears in
+another arXiv version, another feed, or the next rebuild is never sent to
+the transformer again.
+
+Searches keep two size-bounded LRU tables next to the index: prompt
+vectors keyed by (model name, prompt hash), and ranked row ids and scores
+keyed by the prompt hash, k, filters, search mode and index version. A
+rebuild changes the index version, which drops every cached result.
+A query cache call that still finds the file locked by another process
+after LOCK_TIMEOUT runs as a miss, so the search goes on without it.
+"""
+import hashlib
+import json
+import sqlite3
+from functools import wraps
+from os.path import getsize
+from time import time
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+EMBEDDING_CACHE = 'embedding_cache.sqlite'
+QUERY_CACHE = 'query_cache.sqlite'
+MAX_PARAMS = 500  # stay under SQLITE_MAX_VARIABLE_NUMBER on old builds
+MAX_PROMPTS = 10000  # prompt vectors kept by a QueryCache
+MAX_RESULTS = 10000  # ranked results kept by a QueryCache
+LOCK_TIMEOUT = 1.0  # seconds a QueryCache call waits on another writer
+
+
+def skip_if_locked(method):
+    """Run a QueryCache lookup or store as a miss (None) when SQLite
+    reports e.g. 'database is locked' instead of failing the search"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except sqlite3.OperationalError:
+            try:
+                self.con.rollback()
+            except sqlite3.Error:
+                pass
+            return None
+    return wrapper
+
+
+def text_key(text) -> str:
+    """Hash of a description with runs of whitespace collapsed"""
+    return hashlib.sha1(' '.join(str(text).split()).encode()).hexdigest()
+
+
+class EmbeddingCache():
+    """ SQLite table of (model, text hash) -> float32 vector
+    """
+    def __init__(self, filename: str, model: str):
+        self.filename = filename
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+        self.con = sqlite3.connect(filename)
+        self.con.execute('CREATE TABLE IF NOT EXISTS embeddings '
+                         '(model TEXT, key TEXT, vector BLOB, '
+                         'PRIMARY KEY (model, key))')
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Cached vectors for the keys that have one
+
+        Args:
+            keys (List[str]): Hashes from `text_key`
+
+        Returns:
+            Dict[str, np.ndarray]: key -> vector for cache hits
+        """
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        for start in range(0, len(keys), MAX_PARAMS):
+            chunk = keys[start:start+MAX_PARAMS]
+            marks = ','.join('?'*len(chunk))
+            for key, blob in self.con.execute(
+                    f'SELECT key, vector FROM embeddings WHERE model = ? '
+                    f'AND key IN ({marks})', [self.model] + chunk):
+                found[key] = np.frombuffer(blob, dtype=np.float32)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, keys: List[str], embs: np.ndarray):
+        self.con.executemany(
+            'INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)',
+            ((self.model, key, np.asarray(v, dtype=np.float32).tobytes())
+             for key, v in zip(keys, embs)))
+        self.con.commit()
+
+    def report(self):
+        """Print the hit rate of this build and the size of the cache"""
+        rows, = self.con.execute('SELECT COUNT(*) FROM embeddings').fetchone()
+        lookups = self.hits + self.misses
+        rate = 100*self.hits/lookups if lookups else 0
+        print(f'Embedding cache: {self.hits}/{lookups} hits ({rate:.1f}%), '
+              f'{rows} vectors, {getsize(self.filename)/2**20:.1f} MiB '
+              f'in {self.filename}')
+
+    def close(self):
+        self.con.close()
+
+
+class QueryCache():
+    """ SQLite LRU of prompt vectors and ranked results for one index
+    """
+    def __init__(self, filename: str, model: str, version: str,
+                 max_prompts=MAX_PROMPTS, max_results=MAX_RESULTS):
+        self.filename = filename
+        self.model = model
+        self.version = version
+        self.limits = {'prompts': max_prompts, 'results': max_results}
+        self.con = sqlite3.connect(filename, timeout=LOCK_TIMEOUT,
+                                   check_same_thread=False)
+        self.con.execute('CREATE TABLE IF NOT EXISTS prompts '
+                         '(model TEXT, key TEXT, vector BLOB, used REAL, '
+                         'PRIMARY KEY (model, key))')
+        self.con.execute('CREATE TABLE IF NOT EXISTS results '
+                         '(key TEXT PRIMARY KEY, ids BLOB, scores BLOB, '
+                         'used REAL)')
+        self.con.execute('CREATE TABLE IF NOT EXISTS meta '
+                         '(name TEXT PRIMARY KEY, value TEXT)')
+        row = self.con.execute("SELECT value FROM meta "
+                               "WHERE name = 'index_version'").fetchone()
+        if row is None or row[0] != version:  # the index was rebuilt
+            self.con.execute('DELETE FROM results')
+            self.con.execute("INSERT OR REPLACE INTO meta "
+                             "VALUES ('index_version', ?)", (version,))
+        self.con.commit()
+
+    def result_key(self, prompt: str, k: int, **params) -> str:
+        """Hash of everything a ranking depends on
+
+        Args:
+            prompt (str): The prompt (whitespace is normalized)
+            k (int): Number of candidates
+            **params: Search mode, filters and other options
+
+        Returns:
+            str: Key for get_results/put_results
+        """
+        key = json.dumps([self.model, self.version, text_key(prompt), k,
+                          params], sort_keys=True, default=str)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _evict(self, table: str):
+        self.con.execute(
+            f'DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} '
+            f'ORDER BY used LIMIT max(0, (SELECT COUNT(*) FROM {table}) '
+            f'- ?))', (self.limits[table],))
+
+    @skip_if_locked
+    def get_vector(self, prompt: str) -> Optional[np.ndarray]:
+        """Cached vector of a prompt, or None"""
+        key = text_key(prompt)
+        row = self.con.execute('SELECT vector FROM prompts WHERE model = ? '
+                               'AND key = ?', (self.model, key)).fetchone()
+        if row is None:
+            return None
+        self.con.execute('UPDATE prompts SET used = ? WHERE model = ? '
+                         'AND key = ?', (time(), self.model, key))
+        self.con.commit()
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    @skip_if_locked
+    def put_vector(self, prompt: str, vector: np.ndarray):
+        self.con.execute('INSERT OR REPLACE INTO prompts VALUES (?, ?, ?, ?)',
+                         (self.model, text_key(prompt),
+                          np.asarray(vector, dtype=np.float32).tobytes(),
+                          time()))
+        self._evict('prompts')
+        self.con.commit()
+
+    @skip_if_locked
+    def get_results(self, key: str) -> Optional[Tuple[np.ndarray,
+                                                       np.ndarray]]:
+        """Cached row ids and scores for a result_key, or None"""
+        row = self.con.execute('SELECT ids, scores FROM results '
+                               'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self.con.execute('UPDATE results SET used = ? WHERE key = ?',
+                         (time(), key))
+        self.con.commit()
+        return (np.frombuffer(row[0], dtype=np.int64),
+                np.frombuffer(row[1], dtype=np.float32))
+
+    @skip_if_locked
+    def put_results(self, key: str, ids: np.ndarray, scores: np.ndarray):
+        self.con.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                         (key, np.asarray(ids, dtype=np.int64).tobytes(),
+                          np.asarray(scores, dtype=np.float32).tobytes(),
+                          time()))
+        self._evict('results')
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
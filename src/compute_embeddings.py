@@ -4,99 +4,442 @@ Compute embeddings for narratives using SentenceTransformer.
 Args:
     IDIR (str): index director path to directory containing pickled CFPs/FOAs.
     data_files: Files containing CFP/FOA data. Split by get_*.sh scripts
+    --dtype: Storage precision of the embedding matrix (float32 or float16)
+    --ivf-lists: Also build an IVF index with this many lists (0 = none)
+    --quantize: Also write int8 or product-quantized (pq) codes
+    --full: Re-embed every shard instead of only new or changed ones
+    --cache: Persistent description embedding cache (default: in IDIR)
+    --chunk-size: Descriptions encoded and written to disk at a time
+    --devices: Encoding workers, e.g. cpu:16 or cuda:0,cuda:1 (default: auto)
+    --workers: Processes parsing shards ahead of the encoder
+    --columnar: Save Parquet copies of shards under IDIR/columnar/
+    --partition: Sort the matrix by primary category (or feed) for --scope
+    --duplicate-threshold: Cosine similarity of near-duplicate narratives
+        (0 only groups duplicates by id and title)
+    --lexical: Also build the BM25 index for --search lexical/hybrid/prefilter
+    --profile: Print wall time, CPU time and peak RSS of every build phase
+        at exit and write them as a JSON trace (default: IDIR/profile.json)
+    --chrome-trace: With --profile, also write a Chrome trace
 Returns:
-    index_directory/embeddings.pkl
+    index_directory/embeddings.npy: #narratives x #dims matrix
+    index_directory/metadata.pkl: source, filename, row, posted date and
+        categories of each matrix row
+    index_directory/records.sqlite: to_dict fields of each matrix row, with
+        the URLs of its duplicates (other versions, feeds) as Alternates
+    index_directory/ivf.npz: optional approximate nearest-neighbor index
+    index_directory/codes.npy, quantizer.npz: optional compressed vectors
+    index_directory/lexical/: optional BM25 inverted index of the records
+    index_directory/partitions.json: row range of each partition, with
+        --partition
+    index_directory/parts/, manifest.json: per-shard vectors and hashes
+        reused by the next build
+
+Shards are embedded one at a time, in fixed-size chunks written straight
+to disk, and manifest.json is updated after every shard. Peak memory is
+bounded by one shard, and an interrupted build resumes at the first shard
+without a finished part (chunks already encoded are cache hits).
 """
 from typing import List
-from sys import argv
+from argparse import ArgumentParser
 from glob import glob
-from sentence_transformers import SentenceTransformer
+from os import environ, makedirs
+from os.path import basename, exists, join
+from functools import lru_cache
+from math import ceil
+from multiprocessing import cpu_count, get_context
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+import numpy
 import pandas
-import torch
-import data as DATA_CLASSES
+import index as INDEX
+import shard_loader as LOADER
+import records as RECORDS
+import ann as ANN
+import lexical as LEXICAL
+import cache as CACHE
+import tracing as TRACE
 
 MODEL_NAME = 'all-mpnet-base-v2'
-DESCRIPTION_ATTR = {
-                    'ARXIV': 'abstract'
-                    }
+CHUNK_SIZE = 4096
+BATCH_SIZE = 64
+POOL_BATCH_SIZE = 1024  # per GPU worker
+POOLS = {}  # devices -> multi-process pool, started once per build
 
 
-def encode_narratives(N: List[str]) -> pandas.DataFrame:
+def encode_narratives(N: List[str], cache=None,
+                      devices: List[str] = None) -> numpy.ndarray:
     """Encode narratives using SentenceTransformer. Multi-GPU support.
 
-    Model is set to all-mpnet-base-v2.
+    Model is set to all-mpnet-base-v2. With a cache, only descriptions
+    it has never seen (after whitespace normalization) are encoded.
 
     Args:
         N (List[str]): List of narratives to encode. Descriptions of CFPs/FOAs.
+        cache (CACHE.EmbeddingCache, optional): Persistent vector cache
+        devices (List[str], optional): From parse_devices. Defaults to auto.
 
     Returns:
-        pandas.DataFrame: DataFrame with #narratives x #dims.
+        numpy.ndarray: L2-normalized float32 array with #narratives x #dims.
     """
-    transformer = SentenceTransformer(MODEL_NAME)
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    if torch.cuda.device_count() > 1:
-        tds = ['cuda:1', 'cuda:2', 'cuda:0', 'cuda:3']
-        pool = transformer.start_multi_process_pool(target_devices=tds)
-        embs = transformer.encode_multi_process(N,
-                                                pool,
-                                                batch_size=1024,  # 128
-                                                chunk_size=len(N)/1000  # 100
-                                                )
-        transformer.stop_multi_process_pool(pool)
-    else:
-        embs = transformer.encode(N,
-                                  show_progress_bar=True,
-                                  batch_size=64,
-                                  device=device
-                                  )
-    ncols = len(embs[0])
-    attnames = [f'F{i}' for i in range(ncols)]
-    return pandas.DataFrame(embs, columns=attnames)
+    N = list(N)
+    if cache is None:
+        return transform_narratives(N, devices)
+    keys = [CACHE.text_key(n) for n in N]
+    with TRACE.stage('cache_lookup'):
+        found = cache.get_many(keys)
+    misses = {}
+    for key, n in zip(keys, N):
+        if key not in found:
+            misses.setdefault(key, n)
+    if misses:
+        embs = transform_narratives(list(misses.values()), devices)
+        with TRACE.stage('cache_store'):
+            cache.put_many(list(misses), embs)
+        found.update(zip(misses, embs))
+    if not N:
+        return numpy.empty((0, 0), dtype=numpy.float32)
+    return numpy.stack([found[key] for key in keys])
+
+
+@lru_cache(maxsize=None)
+def load_transformer():
+    """Load the {MODEL_NAME} model once per build"""
+    from sentence_transformers import SentenceTransformer  # torch: seconds
+    return SentenceTransformer(MODEL_NAME)
+
+
+def parse_devices(spec: str = None) -> List[str]:
+    """Expand a device list for encoding.
+
+    Args:
+        spec (str, optional): Comma-separated devices, where cpu:N means
+            N CPU worker processes, e.g. 'cpu:8' or 'cuda:0,cuda:1'.
+            Defaults to every GPU, or one CPU process without GPUs.
+
+    Returns:
+        List[str]: One device per encoding worker
+    """
+    import torch  # only here: shard loaders re-run this module's imports
+    if spec is None:
+        if torch.cuda.device_count() > 1:
+            return [f'cuda:{i}' for i in range(torch.cuda.device_count())]
+        return ['cuda' if torch.cuda.is_available() else 'cpu']
+    devices = []
+    for device in spec.split(','):
+        name, _, count = device.partition(':')
+        if name == 'cpu' and count:
+            devices += ['cpu']*int(count)
+        else:
+            devices.append(device)
+    return devices
+
+
+def start_pool(devices: List[str]):
+    """Start (once per build) one encoding worker per device.
+
+    CPU workers split the cores evenly, so they do not oversubscribe. The
+    thread limits are set only while the workers are spawned (they copy
+    the environment at start), then the previous values are restored.
+    """
+    key = tuple(devices)
+    if key not in POOLS:
+        cpu_workers = devices.count('cpu')
+        names = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS'] if cpu_workers else []
+        saved = {name: environ.get(name) for name in names}
+        try:
+            for name in names:
+                environ[name] = str(max(1, cpu_count()//cpu_workers))
+            POOLS[key] = load_transformer().start_multi_process_pool(
+                target_devices=devices)
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    environ.pop(name, None)
+                else:
+                    environ[name] = value
+    return POOLS[key]
+
 
+def stop_pools():
+    for pool in POOLS.values():
+        load_transformer().stop_multi_process_pool(pool)
+    POOLS.clear()
 
-def glob2objects(glob_pattern: str):
-    """Convert globbed files to objects.
+
+def transform_narratives(N: List[str],
+                         devices: List[str] = None) -> numpy.ndarray:
+    """Run SentenceTransformer on narratives. Multi-GPU/CPU support.
+
+    Narratives are sorted by length so each batch (and each worker's
+    chunk) pads to similar lengths, then put back in input order.
 
     Args:
-        glob_pattern (str): Which files to include
+        N (List[str]): List of narratives to encode.
+        devices (List[str], optional): From parse_devices. Defaults to auto.
 
     Returns:
-        List[obj]: A list of class objects for reading each raw data files
+        numpy.ndarray: L2-normalized float32 array with #narratives x #dims.
+    """
+    devices = devices or parse_devices()
+    with TRACE.stage('load_model'):
+        transformer = load_transformer()
+    tic = perf_counter()
+    order = numpy.argsort([-len(n) for n in N], kind='stable')
+    texts = [N[i] for i in order]
+    if len(devices) > 1:
+        with TRACE.stage('start_pool'):
+            pool = start_pool(devices)
+        gpu = devices[0].startswith('cuda')
+        with TRACE.stage('encode', narratives=len(N)):
+            embs = transformer.encode_multi_process(
+                texts,
+                pool,
+                batch_size=POOL_BATCH_SIZE if gpu else BATCH_SIZE,
+                chunk_size=max(1, ceil(len(texts)/len(devices)/4))
+                )
+    else:
+        with TRACE.stage('encode', narratives=len(N)):
+            embs = transformer.encode(texts,
+                                      show_progress_bar=True,
+                                      batch_size=BATCH_SIZE,
+                                      device=devices[0]
+                                      )
+    result = numpy.empty((len(texts), embs.shape[1]), dtype=numpy.float32)
+    result[order] = embs
+    seconds = perf_counter() - tic
+    print(f'Encoded {len(N)} narratives in {seconds:.1f}s '
+          f'({len(N)/seconds:.0f} sentences/s on {len(devices)} workers)')
+    return INDEX.normalize(result)
+
+
+def record_text(record: dict) -> str:
+    """Title and description of a record for the lexical index; missing
+    fields (None, or NaN from an empty CSV cell) add no terms"""
+    return ' '.join(v for v in (record.get('Title'), record.get('Description'))
+                    if isinstance(v, str))
+
+
+def prefetch(filenames: List[str], workers: int, columnar=False):
+    """Load shards on a process pool, at most 2*workers ahead of use.
+
+    Args:
+        filenames (List[str]): Raw data files named FEED_S000
+        workers (int): Loader processes
+        columnar (bool, optional): Also save Parquet copies of the shards
+
+    Yields:
+        Tuple[str, pandas.DataFrame, List[dict]]: In the order of filenames
+    """
+    with ProcessPoolExecutor(workers, mp_context=get_context('spawn')) as pool:
+        pending = deque()
+        for fn in filenames:
+            pending.append((fn, pool.submit(LOADER.load_shard, fn, columnar)))
+            if len(pending) > 2*workers:
+                fn, future = pending.popleft()
+                with TRACE.stage('wait_for_shard', filename=fn):
+                    loaded = future.result()
+                yield (fn, *loaded)
+        while pending:
+            fn, future = pending.popleft()
+            with TRACE.stage('wait_for_shard', filename=fn):
+                loaded = future.result()
+            yield (fn, *loaded)
+
+
+def embed_shard(idir: str, filename: str, df: pandas.DataFrame,
+                records: List[dict], cache=None, chunk_size=CHUNK_SIZE,
+                devices: List[str] = None):
+    """Encode one shard chunk by chunk straight into its part.
+
+    Args:
+        idir (str): Index directory
+        filename (str): Raw data file the rows came from
+        df (pandas.DataFrame): Rows from shard_loader.load_shard
+        records (List[dict]): Records from shard_loader.load_shard
+        cache (CACHE.EmbeddingCache, optional): Persistent vector cache
+        chunk_size (int, optional): Descriptions encoded at a time
+        devices (List[str], optional): From parse_devices. Defaults to auto.
     """
-    files = list(glob(glob_pattern))
-    classes = [f.split('/')[-1].split('_')[0] for f in files]
-    zset = zip(files, classes)
-    print('zset',zset)
-    objs = [getattr(DATA_CLASSES, c)(f, DESCRIPTION_ATTR[c]) for f, c in zset]
-    print('obj',objs)
-    return objs
+    texts = df.description.astype(str)
+    vectors = None
+    for start in range(0, len(df), chunk_size):
+        embs = encode_narratives(texts.iloc[start:start+chunk_size], cache,
+                                 devices)
+        if vectors is None:
+            vectors = INDEX.create_part_vectors(idir, filename,
+                                                (len(df), embs.shape[1]))
+        vectors[start:start+len(embs)] = embs
+    if vectors is None:  # shard without rows
+        vectors = INDEX.create_part_vectors(idir, filename, (0, 0))
+    vectors.flush()
+    del vectors
+    with TRACE.stage('write_part', filename=filename):
+        INDEX.write_part(idir, filename, df, records)
 
 
-def objects2descriptions(Objs: list):
-    """Convert objects to descriptions.
+def stale_shards(idir: str, shards: List[str], manifest: dict):
+    """Shards that are new or changed since their part was embedded.
 
     Args:
-        objects (list): List of class objects
+        idir (str): Index directory
+        shards (List[str]): Raw data files named FEED_S000
+        manifest (dict): From INDEX.read_manifest
 
     Returns:
-        pandas.DataFrame: DataFrame with descriptions read from objects
+        Dict[str, str]: shard -> content hash for shards to re-embed
     """
-    return pandas.concat([obj.get_descriptions() for obj in Objs],
-                         ignore_index=True)
+    stale = {}
+    for fn in shards:
+        digest = INDEX.file_digest(fn)
+        vectors_fn = INDEX.part_paths(idir, fn)[0]
+        if manifest['shards'].get(basename(fn)) != digest \
+                or not exists(vectors_fn):
+            stale[fn] = digest
+    return stale
 
 
 if __name__ == "__main__":
-    IDIR = argv[1]
-    objects = glob2objects(f'{IDIR}/*_S*')
-    descriptions = objects2descriptions(objects)
-    df = descriptions.drop_duplicates(
-        subset=['description'],
-        keep='last',
-        ignore_index=True
-        )
-    #df = descriptions
-    if not torch.cuda.is_available():
+    p = ArgumentParser()
+    p.add_argument('IDIR', help='Index directory holding FEED_S000 shards')
+    p.add_argument('--dtype', default='float32', choices=INDEX.DTYPES,
+                   help='Storage precision of the embedding matrix')
+    p.add_argument('--ivf-lists', default=0, type=int,
+                   help='Build an IVF index with this many lists, '
+                        'e.g. 4*sqrt(#narratives); 0 skips it')
+    p.add_argument('--quantize', choices=ANN.QUANTIZERS,
+                   help='Also write compressed codes for --search quantized')
+    p.add_argument('--pq-subspaces', default=ANN.PQ_SUBSPACES, type=int,
+                   help='Bytes per vector with --quantize pq')
+    p.add_argument('--full', action='store_true',
+                   help='Re-embed every shard, ignoring parts/ and manifest')
+    p.add_argument('--cache',
+                   help='Description embedding cache shared across builds '
+                        f'(default: IDIR/{CACHE.EMBEDDING_CACHE})')
+    p.add_argument('--no-cache', action='store_true',
+                   help='Encode every description, ignoring the cache')
+    p.add_argument('--chunk-size', default=CHUNK_SIZE, type=int,
+                   help='Descriptions encoded and written to disk at a time')
+    p.add_argument('--devices',
+                   help='Encoding workers: cpu:N for N CPU processes or a '
+                        'list such as cuda:0,cuda:1 (default: every GPU)')
+    p.add_argument('--workers', default=min(8, cpu_count()), type=int,
+                   help='Processes parsing shards while others are encoded')
+    p.add_argument('--columnar', action='store_true',
+                   help='Save Parquet copies of shards so later builds and '
+                        'searches skip CSV parsing')
+    p.add_argument('--partition', action='store_true',
+                   help='Lay out the matrix by primary arXiv category (or '
+                        'feed) so main.py --scope scans only some of it')
+    p.add_argument('--duplicate-threshold', default=ANN.DUPLICATE_THRESHOLD,
+                   type=float,
+                   help='Fold narratives at least this cosine-similar into '
+                        'one entry; 0 only folds same id or title')
+    p.add_argument('--lexical', action='store_true',
+                   help='Also build the BM25 index of titles and '
+                        'descriptions for main.py --search lexical, hybrid '
+                        'or prefilter')
+    p.add_argument('--profile', nargs='?', const='', metavar='TRACE',
+                   help='Time every build phase and write a JSON trace '
+                        '(default: IDIR/profile.json)')
+    p.add_argument('--chrome-trace', metavar='FILE',
+                   help='With --profile, also write a Chrome trace')
+    args = p.parse_args()
+    IDIR = args.IDIR
+    if args.profile is not None:
+        TRACE.profile(args.profile or join(IDIR, 'profile.json'),
+                      args.chrome_trace)
+    cache = None
+    if not args.no_cache:
+        cache = CACHE.EmbeddingCache(
+            args.cache or join(IDIR, CACHE.EMBEDDING_CACHE), MODEL_NAME)
+    makedirs(join(IDIR, INDEX.PARTS), exist_ok=True)
+    shards = sorted(glob(f'{IDIR}/*_S*'))
+    manifest = INDEX.read_manifest(IDIR, MODEL_NAME)
+    if args.full:
+        manifest['shards'] = {}
+    for name in set(manifest['shards']) - {basename(fn) for fn in shards}:
+        INDEX.remove_part(IDIR, name)  # shard deleted since the last build
+        del manifest['shards'][name]
+    with TRACE.stage('stale_shards'):
+        stale = stale_shards(IDIR, shards, manifest)
+    print(f'Embedding {len(stale)} new or changed of {len(shards)} shards')
+    devices = parse_devices(args.devices)
+    import torch  # already loaded by parse_devices
+    if stale and not torch.cuda.is_available():
         print('Warning: No GPU detected. Using CPU.')
-    embeddings = encode_narratives(df.description.astype(str))
-    result = pandas.concat([df, embeddings], axis=1)
-    result.to_pickle(f'{IDIR}/embeddings.pkl')
+    tic = perf_counter()
+    loaded = prefetch(list(stale), args.workers, args.columnar)
+    for i, (fn, df, records) in enumerate(loaded, 1):
+        manifest['shards'].pop(basename(fn), None)  # part is being rewritten
+        INDEX.write_manifest(IDIR, manifest)
+        with TRACE.stage('embed_shard', filename=fn, rows=len(df)):
+            embed_shard(IDIR, fn, df, records, cache, args.chunk_size,
+                        devices)
+        manifest['shards'][basename(fn)] = stale[fn]
+        INDEX.write_manifest(IDIR, manifest)  # checkpoint: part is complete
+        print(f'[{i}/{len(stale)}] {fn}: {len(df)} rows '
+              f'at {perf_counter() - tic:.1f}s')
+    INDEX.write_manifest(IDIR, manifest)
+    stop_pools()
+    if cache is not None:
+        cache.report()
+        cache.close()
+    embeddings_fn = INDEX.embeddings_path(IDIR)
+    records_fn = RECORDS.records_path(embeddings_fn)
+    with TRACE.stage('merge_parts'):
+        df = INDEX.merge_parts(IDIR, shards, args.dtype, args.partition)
+    embeddings = INDEX.read_embeddings(INDEX.staged_path(embeddings_fn))
+    pairs = None
+    if args.duplicate_threshold:
+        with TRACE.stage('near_duplicates'):
+            pairs = ANN.near_duplicates(
+                embeddings, args.duplicate_threshold,
+                order=numpy.argsort(df.digest.to_numpy(), kind='stable'))
+    with TRACE.stage('duplicate_groups'):
+        groups = INDEX.duplicate_groups(df, embeddings, pairs)
+    del embeddings
+    merged = len(df)
+    with TRACE.stage('deduplicate'):
+        df, alternates = INDEX.deduplicate(IDIR, df, groups, args.dtype)
+    print(f'Kept {len(df)} of {merged} narratives; {len(alternates)} '
+          f'have duplicates listed as alternates')
+    with TRACE.stage('write_metadata'):
+        INDEX.write_partitions(
+            INDEX.staged_path(INDEX.partitions_path(IDIR)), df)
+        INDEX.write_metadata(
+            INDEX.staged_path(INDEX.metadata_path(embeddings_fn)), df)
+    with TRACE.stage('write_records'):
+        RECORDS.write_records(
+            INDEX.staged_path(records_fn),
+            INDEX.iter_part_records(IDIR, shards, df, alternates))
+    # rows moved; old derived indexes would point at the wrong ones
+    LEXICAL.remove_lexical(LEXICAL.lexical_path(embeddings_fn))
+    ANN.remove_ivf(ANN.ivf_path(embeddings_fn))
+    ANN.remove_quantized(embeddings_fn)
+    with TRACE.stage('install'):
+        INDEX.install([records_fn, INDEX.partitions_path(IDIR),
+                       INDEX.metadata_path(embeddings_fn), embeddings_fn])
+    if args.lexical:
+        with TRACE.stage('build_lexical'):
+            LEXICAL.build_lexical(
+                LEXICAL.lexical_path(embeddings_fn),
+                ((i, record_text(r))
+                 for i, r in RECORDS.iter_records(records_fn)),
+                len(df))
+    embeddings = INDEX.read_embeddings(embeddings_fn)
+    if args.ivf_lists:
+        with TRACE.stage('build_ivf'):
+            ivf = ANN.build_ivf(embeddings, args.ivf_lists)
+            ANN.write_ivf(ANN.ivf_path(embeddings_fn), ivf)
+    if args.quantize:
+        with TRACE.stage('quantize'):
+            quantizer = ANN.train_quantizer(embeddings, args.quantize,
+                                            args.pq_subspaces)
+            ANN.write_quantizer(ANN.quantizer_path(embeddings_fn), quantizer)
+            ANN.write_codes(ANN.codes_path(embeddings_fn), quantizer,
+                            embeddings)
+        codes = numpy.load(ANN.codes_path(embeddings_fn), mmap_mode='r')
+        print(f'{args.quantize} codes: '
+              f'{ANN.footprint(quantizer, codes)/2**20:.1f} MiB '
+              f'vs {embeddings.nbytes/2**20:.1f} MiB full precision')
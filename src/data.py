@@ -1,6 +1,10 @@
 from datetime import datetime
 import pandas as pd
-from math import isnan
+from os import makedirs
+from os.path import basename, dirname, exists, getmtime, join
+
+COLUMNAR = 'columnar'  # Parquet copies of raw shards, next to the shards
+MMDDYYYY = '%m/%d/%Y'  # date format of to_dict fields
 
 
 ATTRIBUTES = [
@@ -39,14 +43,46 @@ ATTRIBUTES = [
     'Description',
     'Prompt',
     'QueryName',
-    'Authors'
+    'Authors',
+    'Alternates'
 ]
 
+def to_dates(values, formats, exact=True) -> pd.Series:
+    """ Parse a column of dates, one vectorized pass per format
+
+    Args:
+        values (pd.Series): Raw dates; numbers are read as MMDDYYYY digits
+        formats (List[str]): strptime formats, tried in order
+        exact (bool, optional): False lets a format match inside a longer
+            string, e.g. '%Y-%m-%d' in '2024-01-31T17:00:00-05:00'
+
+    Returns:
+        pd.Series: datetime64 dates, NaT where no format matched
+    """
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values):
+        values = values.astype('Int64').astype(str).str.zfill(8)
+    values = values.astype(str).str.strip()
+    dates = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    for f in formats:
+        missing = dates.isna()
+        if not missing.any():
+            break
+        dates[missing] = pd.to_datetime(values[missing], format=f,
+                                        exact=exact, errors='coerce')
+    return dates
+
+
 class Raw_Data_Index():
     '''
     Object to handle data wrangling. Find, fetch, extract, parse
     are unique for each data source, and they need to be merged.
     '''
+    DATE_COLUMNS = {}  # raw date column -> formats, parsed once per shard
+    EXACT_DATES = True
+    MISSING_DATE = ''
+    POSTED = None  # date column of 'Posted', if the source has one
+
     def __init__(self, filename: str, desc_att: str):
         self.filename = filename
         self.description_attribute = desc_att
@@ -75,6 +111,66 @@ class Raw_Data_Index():
     def mk_empty_row(self):
         return {k: None for k in ATTRIBUTES}
 
+    def parse_dates(self):
+        '''
+            Parse every DATE_COLUMNS column of the shard into typed dates
+        '''
+        self.dates = pd.DataFrame(
+            {c: to_dates(self.df[c], formats, self.EXACT_DATES)
+             for c, formats in self.DATE_COLUMNS.items() if c in self.df},
+            index=self.df.index)
+
+    def date_at(self, idx: int, column: str):
+        '''
+            A parsed date of one row as MM/DD/YYYY
+        '''
+        date = self.dates[column].iat[idx]
+        if pd.isna(date):
+            return self.MISSING_DATE
+        return date.strftime(MMDDYYYY)
+
+    def get_posted(self):
+        '''
+            Posted date of every row, for filtering searches; sources
+            without one have none (NaT)
+        '''
+        if self.POSTED:
+            return self.dates[self.POSTED]
+        return pd.Series(pd.NaT, index=self.df.index, dtype='datetime64[ns]')
+
+    def get_categories(self):
+        '''
+            Space-separated subject categories of every row, for filtering
+            searches; sources without categories have none
+        '''
+        return pd.Series(None, index=self.df.index, dtype=object)
+
+    def columnar_path(self):
+        return join(dirname(self.filename), COLUMNAR,
+                    basename(self.filename) + '.parquet')
+
+    def has_columnar(self):
+        columnar = self.columnar_path()
+        return exists(columnar) and \
+            getmtime(columnar) >= getmtime(self.filename)
+
+    def read_table(self, columns=None, **csv_options):
+        '''
+            Read the raw shard, preferring an up-to-date Parquet copy that
+            skips CSV parsing and can load only some columns
+        '''
+        if self.has_columnar():
+            return pd.read_parquet(self.columnar_path(), columns=columns)
+        return pd.read_csv(self.filename, usecols=columns, **csv_options)
+
+    def write_columnar(self):
+        '''
+            Save the parsed shard as Parquet so later reads skip the CSV
+        '''
+        columnar = self.columnar_path()
+        makedirs(dirname(columnar), exist_ok=True)
+        self.df.to_parquet(columnar)
+
     def to_csv(self, row: int, similarity: float):
         """ Convert the data to a pandas DataFrame
 
@@ -93,12 +189,18 @@ class Raw_Data_Index():
 
 
 class NSF(Raw_Data_Index):
+    DATE_COLUMNS = {'Posted_date': ['%Y-%m-%d'],
+                    'Next_due_date': ['%Y-%m-%d']}
+    EXACT_DATES = False  # e.g. 'Full Proposal, 2024-01-31'
+    POSTED = 'Posted_date'
+
     def __init__(self, filename: str, desc_att: str):
         super().__init__(filename, desc_att)
         self.load_data()
 
     def load_data(self):
-        self.df = pd.read_csv(self.filename)
+        self.df = self.read_table()
+        self.parse_dates()
 
     def get_descriptions(self):
         return pd.DataFrame({'source': self.__class__.__name__,
@@ -107,24 +209,17 @@ class NSF(Raw_Data_Index):
                              'description': self.df[self.description_attribute]
                              })
 
-    def date2MMDDYYYY(self, date: str):
-        if isinstance(date, float):
-            return ''
-        if ' ' in date:
-            date = date.split(',')[1].strip()
-        return datetime.strptime(date, '%Y-%m-%d').strftime('%m/%d/%Y')
-
     def to_dict(self, idx: int, similarity: float):
         row = self.df.iloc[idx]
         result = self.mk_empty_row()
         result['Similarity'] = similarity
         result['Feed'] = 'NSF'
         result['Title'] = row.Title
-        result['Posted'] = self.date2MMDDYYYY(row.Posted_date)
+        result['Posted'] = self.date_at(idx, 'Posted_date')
         result['Description'] = row.Synopsis
         result['AwardType'] = row.Award_Type
         result['DueDates'] = [row['Next_due_date']]# double check
-        result['CloseDate'] = self.date2MMDDYYYY(row['Next_due_date'])
+        result['CloseDate'] = self.date_at(idx, 'Next_due_date')
         result['RollingDecision'] = row['Proposals_accepted_anytime']
         result['ProgramID'] = row.Program_ID
         result['FeedID'] = row.NSF_PD_Num
@@ -138,12 +233,18 @@ class NSF(Raw_Data_Index):
 
 
 class SCS(Raw_Data_Index):
+    DATE_COLUMNS = {'Post Date': ['%m/%d/%y', '%Y-%m-%d'],
+                    'Due Date': ['%m/%d/%y', '%Y-%m-%d']}
+    MISSING_DATE = None
+    POSTED = 'Post Date'
+
     def __init__(self, filename: str, desc_att: str):
         super().__init__(filename, desc_att)
         self.load_data()
 
     def load_data(self):
-        self.df = pd.read_csv(self.filename, lineterminator='\n')  # ^M in data
+        self.df = self.read_table(lineterminator='\n')  # ^M in data
+        self.parse_dates()
 
     def get_descriptions(self):
         return pd.DataFrame({'source': self.__class__.__name__,
@@ -152,21 +253,6 @@ class SCS(Raw_Data_Index):
                              'description': self.df[self.description_attribute]
                              })
 
-    def date2MMDDYYYY(self, date: str):
-        if isinstance(date, float):
-            return None
-        formats = ['%m/%d/%y', '%Y-%m-%d']
-        dt = None
-        for f in formats:
-            try:
-                dt = datetime.strptime(date.strip(), f).strftime('%m/%d/%Y')
-                break
-            except:
-                pass
-        if not dt:
-            print('scs not a DT', date)
-        return dt
-
     def to_dict(self, idx: int, similarity: float):
         row = self.df.iloc[idx]
         result = self.mk_empty_row()
@@ -175,8 +261,8 @@ class SCS(Raw_Data_Index):
         result['Title'] = row['Title']
         result['Sponsor'] = row['Agency/Organization']
         result['SponsorType'] = row['Type']
-        result['Posted'] = self.date2MMDDYYYY(row['Post Date'])
-        result['CloseDate'] = self.date2MMDDYYYY(row['Due Date'])
+        result['Posted'] = self.date_at(idx, 'Post Date')
+        result['CloseDate'] = self.date_at(idx, 'Due Date')
         result['URL'] = 'https://docs.google.com/spreadsheets/d/19vQMmH0Vsg0tvf4ia3SBqWTQ8lowQCPhyTOt3hQSVHk/edit?usp=sharing'
         result['Amount'] = row['Amount/Duration']
         result['Description'] = row['Brief Description']
@@ -185,12 +271,18 @@ class SCS(Raw_Data_Index):
 
 
 class CMU(Raw_Data_Index):
+    DATE_COLUMNS = {'Internal Letter of Intent Deadline': [MMDDYYYY],
+                    'Internal Pre-Proposal Deadline': [MMDDYYYY],
+                    'Final Sponsor Deadline': [MMDDYYYY]}
+    MISSING_DATE = None
+
     def __init__(self, filename: str, desc_att: str):
         super().__init__(filename, desc_att)
         self.load_data()
 
     def load_data(self):
-        self.df = pd.read_csv(self.filename)
+        self.df = self.read_table()
+        self.parse_dates()
 
     def get_descriptions(self):
         return pd.DataFrame({'source': self.__class__.__name__,
@@ -199,11 +291,6 @@ class CMU(Raw_Data_Index):
                              'description': self.df[self.description_attribute]
                              })
 
-    def date2MMDDYYYY(self, date: str):
-        if isinstance(date, float):
-            return None
-        return datetime.strptime(date, '%m/%d/%Y').strftime('%m/%d/%Y')
-
     def to_dict(self, idx: int, similarity: float):
         row = self.df.iloc[idx]
         result = self.mk_empty_row()
@@ -215,10 +302,10 @@ class CMU(Raw_Data_Index):
         result['Posted'] = 'NA'
         result['ProgramID'] = row['Solicitation Number']
         result['SponsorType'] = 'NA'  # row['Federal/Non-Federal']
-        result['DueDates'] = {'InternalLOI': self.date2MMDDYYYY(row['Internal Letter of Intent Deadline']),
-                              'InternalPPD': self.date2MMDDYYYY(row['Internal Pre-Proposal Deadline']),
+        result['DueDates'] = {'InternalLOI': self.date_at(idx, 'Internal Letter of Intent Deadline'),
+                              'InternalPPD': self.date_at(idx, 'Internal Pre-Proposal Deadline'),
                               #'NextDueDate':self.date2MMDDYYYY(row['1st Sponsor Deadline']),
-                              'FinalDueDate': self.date2MMDDYYYY(row['Final Sponsor Deadline'])
+                              'FinalDueDate': self.date_at(idx, 'Final Sponsor Deadline')
                              }
         result['CloseDate'] = ''
         result['LimitedSubmissionInfo'] = row['CMU Limit']
@@ -232,12 +319,16 @@ class CMU(Raw_Data_Index):
 
 
 class EXTERNAL(Raw_Data_Index):
+    DATE_COLUMNS = {'Deadline': [MMDDYYYY]}
+    MISSING_DATE = None
+
     def __init__(self, filename: str, desc_att: str):
         super().__init__(filename, desc_att)
         self.load_data()
 
     def load_data(self):
-        self.df = pd.read_csv(self.filename)
+        self.df = self.read_table()
+        self.parse_dates()
 
     def get_descriptions(self):
         return pd.DataFrame({'source': self.__class__.__name__,
@@ -246,11 +337,6 @@ class EXTERNAL(Raw_Data_Index):
                              'description': self.df[self.description_attribute]
                             })
 
-    def date2MMDDYYYY(self, date: str):
-        if isinstance(date, float):
-            return None
-        return datetime.strptime(date, '%m/%d/%Y').strftime('%m/%d/%Y')
-
     def to_dict(self, idx: int, similarity:float):
         # Opportunity Name,Organization,Deadline,Early Career,Description,URL,$ Amount of Award,Duration of Award
         row = self.df.iloc[idx]
@@ -263,8 +349,8 @@ class EXTERNAL(Raw_Data_Index):
         result['Posted'] = 'NA'
         # result['ProgramID'] = row['Solicitation Number']
         result['SponsorType'] = 'External Foundation'#row['Federal/Non-Federal']
-        result['DueDates'] = {'Deadline':self.date2MMDDYYYY(row['Deadline'])}
-        result['CloseDate'] = self.date2MMDDYYYY(row['Deadline'])
+        result['DueDates'] = {'Deadline': self.date_at(idx, 'Deadline')}
+        result['CloseDate'] = self.date_at(idx, 'Deadline')
         # result['LimitedSubmissionInfo'] = row['CMU Limit']
         # result['SubmissionRequirements'] = row['Proposal Requirements (internal, external nominations)']
         result['URL'] = 'https://www.cmu.edu/engage/partner/foundations/faculty-staff/index.html'
@@ -278,12 +364,18 @@ class EXTERNAL(Raw_Data_Index):
 
 
 class GFORWARD(Raw_Data_Index):
+    DATE_COLUMNS = {'Submit Date': ['%Y-%m-%d', '%B %d, %Y'],
+                    'Modified Date': ['%Y-%m-%d', '%B %d, %Y']}
+    EXACT_DATES = False  # e.g. 'Submit Date: March 1, 2024'
+    MISSING_DATE = None
+
     def __init__(self, filename: str, desc_att: str):
         super().__init__(filename, desc_att)
         self.load_data()
 
     def load_data(self):
-        self.df = pd.read_csv(self.filename)
+        self.df = self.read_table()
+        self.parse_dates()
 
     def get_descriptions(self):
         return pd.DataFrame({'source': self.__class__.__name__,
@@ -307,6 +399,16 @@ class GFORWARD(Raw_Data_Index):
             print('gforward not a DT', date)
         return dt
 
+    def get_posted(self):
+        '''
+            The last 'Submit Date:' line of Deadlines, as to_dict reads it
+        '''
+        submitted = self.df['Deadlines'].astype(str).str.findall(
+            r'Submit Date:([^\n]*)').str[-1]
+        submitted = submitted.where(~submitted.str.contains(':', na=False),
+                                    submitted.str.split(':').str[1])
+        return to_dates(submitted, ['%Y-%m-%d', '%B %d, %Y'])
+
     def to_dict(self, idx: int, similarity: float):
         row = self.df.iloc[idx]
         result = self.mk_empty_row()
@@ -342,8 +444,8 @@ class GFORWARD(Raw_Data_Index):
         result['ApplicantType'] = row['Applicant Types']
         result['Categories'] = row['Categories']
         result['Contacts'] = row['Contacts']
-        result['DueDates']['Submit Date'] = self.date2MMDDYYYY(row['Submit Date'])
-        result['ModifiedDate'] = self.date2MMDDYYYY(row['Modified Date'])
+        result['DueDates']['Submit Date'] = self.date_at(idx, 'Submit Date')
+        result['ModifiedDate'] = self.date_at(idx, 'Modified Date')
         result['URL'] = row['GrantForward URL']
         result['CitizenshipReq'] = row['Citizenships']
         result['MaxNumAwards'] = row['Maximum Number of Awards']
@@ -356,12 +458,18 @@ class GFORWARD(Raw_Data_Index):
 
 
 class GRANTS(Raw_Data_Index):
+    DATE_COLUMNS = {'PostDate': ['%m%d%Y', '%Y-%m-%d'],
+                    'CloseDate': ['%m%d%Y', '%Y-%m-%d'],
+                    'LastUpdatedDate': ['%m%d%Y', '%Y-%m-%d']}
+    POSTED = 'PostDate'
+
     def __init__(self, filename: str, desc_att: str):
         super().__init__(filename, desc_att)
         self.load_data()
 
     def load_data(self):
-        self.df = pd.read_csv(self.filename)
+        self.df = self.read_table()
+        self.parse_dates()
 
     def get_descriptions(self):
         return pd.DataFrame({'source': self.__class__.__name__,
@@ -370,24 +478,6 @@ class GRANTS(Raw_Data_Index):
                              'description': self.df[self.description_attribute]
                             })
 
-    def date2MMDDYYYY(self, date: str):
-        if isinstance(date, datetime):
-            return date.strftime('%m/%d/%Y')
-        if isinstance(date, float):
-            if isnan(date):
-                return ''
-            else:
-                date = str(int(date))
-        dt = None
-        for f in ['%m%d%Y', '%Y-%m-%d']:
-            try:
-                dt = datetime.strptime(date, f).strftime('%m/%d/%Y')
-            except:
-                pass
-        if not dt:
-            print('stumped!', date)
-        return dt
-
     def to_dict(self, idx: int, similarity: float):
         # https://apply07.grants.gov/help/html/help/index.htm#t=XMLExtract%2FXMLExtract.htm
         row = self.df.iloc[idx]
@@ -418,16 +508,10 @@ class GRANTS(Raw_Data_Index):
         result['Eligibility'] = row['AdditionalInformationOnEligibility']
         # AgencyCode
         result['Sponsor'] = row['AgencyName']
-        if isnan(row['PostDate']):
-            result['Posted'] = ''
-        else:
-            result['Posted'] = self.date2MMDDYYYY(str(int(row['PostDate'])))
+        result['Posted'] = self.date_at(idx, 'PostDate')
         result['DueDates'] = {}
-        result['CloseDate'] = self.date2MMDDYYYY(row['CloseDate'])
-        if isnan(row['LastUpdatedDate']):
-            result['ModifiedDate'] = ''
-        else:
-            result['ModifiedDate'] = self.date2MMDDYYYY(row['CloseDate'])
+        result['CloseDate'] = self.date_at(idx, 'CloseDate')
+        result['ModifiedDate'] = self.date_at(idx, 'LastUpdatedDate')
         result['MaxAmount'] = row['AwardCeiling']
         result['MinAmount'] = row['AwardFloor']
         result['Amount'] = row['EstimatedTotalProgramFunding']
@@ -457,7 +541,8 @@ class PIVOT(Raw_Data_Index):
         self.load_data()
 
     def load_data(self):
-        self.df = pd.read_csv(self.filename)
+        self.df = self.read_table()
+        self.parse_dates()
     def get_descriptions(self):
         return pd.DataFrame({'source': self.__class__.__name__,
                              'filename': self.filename,
@@ -470,6 +555,17 @@ class PIVOT(Raw_Data_Index):
             return ''
         return datetime.strptime(date.strip(), '%d %b %Y').strftime('%m/%d/%Y')
 
+    def get_posted(self):
+        '''
+            The date of the first sponsor line of Upcoming deadlines, as
+            to_dict reads it
+        '''
+        lines = self.df['Upcoming deadlines'].astype(str).str.split('\n')
+        lines = lines.explode()
+        lines = lines[lines.str.contains('sponsor')]
+        first = lines.groupby(level=0).first().str.split(' - ').str[0]
+        return to_dates(first.reindex(self.df.index), ['%d %b %Y'])
+
     def to_dict(self, idx: int, similarity: float):
         row = self.df.iloc[idx]
         result = self.mk_empty_row()
@@ -518,12 +614,18 @@ class PIVOT(Raw_Data_Index):
 
 
 class SAM(Raw_Data_Index):
+    DATE_COLUMNS = {c: ['%Y-%m-%d'] for c in ('PostedDate', 'ArchiveDate',
+                                              'ResponseDeadLine', 'AwardDate')}
+    EXACT_DATES = False  # e.g. '2024-01-31T17:00:00-05:00'
+    POSTED = 'PostedDate'
+
     def __init__(self, filename: str, desc_att: str):
         super().__init__(filename, desc_att)
         self.load_data()
 
     def load_data(self):
-        self.df = pd.read_csv(self.filename)
+        self.df = self.read_table()
+        self.parse_dates()
 
     def get_descriptions(self):
         return pd.DataFrame({'source': self.__class__.__name__,
@@ -532,33 +634,6 @@ class SAM(Raw_Data_Index):
                              'description': self.df[self.description_attribute]
                              })
 
-    def date2MMDDYYYY(self, date: str):
-        if isinstance(date, float):
-            if isnan(date):
-                return ''
-            else: print('stumped', date)
-        if '.' in date:
-            date = date.split('.')[0].strip()
-        formats = ['%Y-%m-%d %H:%M:%S-%U',
-                   '%Y-%m-%d',
-                   '%Y-%m-%dT%H:%M:%S-%U:%W',
-                   '%Y-%m-%d %H:%M:%S',
-                   '%Y-%m-%dT%H:%M:%S',
-                   '%Y-%m-%dT%H:%M+%S:%U',
-                   '%Y-%m-%dT%H:%M%:%S+%U:%W',
-                   '%Y-%m-%dT%H:%M:%S+%U:%W'
-                   ]
-        dt = None
-        for f in formats:
-            try:
-                dt = datetime.strptime(date, f).strftime('%m/%d/%Y')
-                break
-            except:
-                pass
-        if not dt:
-            print('stumped!', date)
-        return dt
-
     def to_dict(self, idx: int, similarity: float):
         row = self.df.iloc[idx]
         result = self.mk_empty_row()
@@ -573,15 +648,15 @@ class SAM(Raw_Data_Index):
         # FPDS Code
         # Office
         # AAC Code
-        result['Posted'] = self.date2MMDDYYYY(row['PostedDate'])
+        result['Posted'] = self.date_at(idx, 'PostedDate')
         result['AwardType'] = row['Type']
         # BaseType
         # ArchiveType
-        result['DueDates'] = {'ArchiveDate': self.date2MMDDYYYY(row['ArchiveDate']),
-                              'ResponseDeadLine': self.date2MMDDYYYY(row['ResponseDeadLine']),
-                              'AwardDate': self.date2MMDDYYYY(row['AwardDate'])
+        result['DueDates'] = {'ArchiveDate': self.date_at(idx, 'ArchiveDate'),
+                              'ResponseDeadLine': self.date_at(idx, 'ResponseDeadLine'),
+                              'AwardDate': self.date_at(idx, 'AwardDate')
                               }
-        result['CloseDate'] = self.date2MMDDYYYY(row['ResponseDeadLine'])
+        result['CloseDate'] = self.date_at(idx, 'ResponseDeadLine')
         # SetASideCode
         # SetASide
         # NaicsCode
@@ -611,12 +686,18 @@ class SAM(Raw_Data_Index):
 
 
 class ARXIV(Raw_Data_Index):
+    DATE_COLUMNS = {'version_created': ['%d %b %Y', '%Y-%m-%d'],
+                    'last_update': ['%Y-%m-%d']}
+    EXACT_DATES = False  # e.g. 'Mon, 2 Apr 2007 19:18:42 GMT'
+    POSTED = 'version_created'
+
     def __init__(self, filename: str, desc_att: str):
         super().__init__(filename, desc_att)
         self.load_data()
 
     def load_data(self):
-        self.df = pd.read_csv(self.filename, quotechar='"')
+        self.df = self.read_table(quotechar='"')
+        self.parse_dates()
 
     def get_descriptions(self):
         return pd.DataFrame({'source': self.__class__.__name__,
@@ -625,26 +706,8 @@ class ARXIV(Raw_Data_Index):
                              'description': self.df[self.description_attribute]
                              })
 
-    def date2MMDDYYYY(self, date: str):
-        if isinstance(date, float):
-            if isnan(date):
-                return ''
-            else: print('stumped', date)
-        if '.' in date:
-            date = date.split('.')[0].strip()
-        formats = ['%a, %d %b %Y %H:%M:%S %Z',
-                   '%Y-%m-%d'
-                   ]
-        dt = None
-        for f in formats:
-            try:
-                dt = datetime.strptime(date, f).strftime('%m/%d/%Y')
-                break
-            except:
-                pass
-        if not dt:
-            print('stumped!', date)
-        return dt
+    def get_categories(self):
+        return self.df['categories']
 
     def to_dict(self, idx: int, similarity: float):
         row = self.df.iloc[idx]
@@ -660,7 +723,7 @@ class ARXIV(Raw_Data_Index):
         # FPDS Code
         # Office
         # AAC Code
-        result['Posted'] = self.date2MMDDYYYY(row['version_created'])
+        result['Posted'] = self.date_at(idx, 'version_created')
         result['AwardType'] = 'NA'  # row['Type']
         # BaseType
         # ArchiveType
@@ -668,7 +731,7 @@ class ARXIV(Raw_Data_Index):
                               #'ResponseDeadLine': self.date2MMDDYYYY(row['ResponseDeadLine']),
                               #'AwardDate': self.date2MMDDYYYY(row['AwardDate'])
                               #}
-        result['CloseDate'] = self.date2MMDDYYYY(row['last_update'])
+        result['CloseDate'] = self.date_at(idx, 'last_update')
         # SetASideCode
         # SetASide
         # NaicsCode
@@ -0,0 +1,597 @@
+"""
+On-disk layout of the Dr. Draft embedding index.
+
+The index directory holds the narrative vectors as one contiguous `.npy`
+matrix (#narratives x #dims) next to a small metadata table that maps each
+matrix row back to the raw data file it came from. The matrix is opened
+with `np.memmap` so searches start without reading it into memory and
+concurrent searches share the OS page cache.
+
+Each raw shard is embedded into its own part under `parts/`, and
+`manifest.json` records the content hash of the shard each part came
+from. A rebuild only re-embeds shards whose hash changed, then merges
+all parts into the matrix.
+
+The metadata also holds the posted date and subject categories of every
+row, so searches restricted by `filter_mask` skip the other rows before
+any vector is scored. A build may also sort the matrix by partition
+(primary arXiv category, or feed for other sources) and list the row range
+of each partition in `partitions.json`, so a scoped search only touches the
+pages of the partitions it selects.
+
+Duplicates (other versions of a paper, cross-listed feeds, near-identical
+abstracts) are resolved at build: only the canonical entry of each group
+stays in the matrix, and its record lists the URLs of its alternates.
+
+A build writes the matrix, metadata, partitions and records under
+`staged_path` names and `install`s them together at the end, so a search
+never pairs a new matrix with old metadata or records.
+"""
+import hashlib
+import json
+import re
+from os import remove, replace, stat
+from os.path import basename, dirname, exists, join
+import numpy as np
+import pandas as pd
+
+EMBEDDINGS = 'embeddings.npy'
+METADATA = 'metadata.pkl'
+PARTS = 'parts'
+MANIFEST = 'manifest.json'
+PARTITIONS = 'partitions.json'
+DTYPES = ('float32', 'float16')
+FORMAT = 3  # layout of parts/; parts of another format are re-embedded
+FILTERS = ['posted', 'categories']  # per-row arrays for filter_mask
+KEYS = ['title_key', 'id_key']  # rows sharing a key may be duplicates
+TITLE_THRESHOLD = 0.9  # same title is a duplicate only if this similar
+BLOCK = 65536  # rows copied or compared at a time
+STAGED = '.tmp'  # suffix of index files written but not yet installed
+
+
+def embeddings_path(idir: str) -> str:
+    return join(idir, EMBEDDINGS)
+
+
+def metadata_path(embeddings_fn: str) -> str:
+    """Metadata always lives next to the embedding matrix"""
+    return join(dirname(embeddings_fn), METADATA)
+
+
+def staged_path(filename: str) -> str:
+    """Where a build writes an index file before `install`"""
+    return filename + STAGED
+
+
+def install(filenames: list):
+    """Move the staged files over the live ones, in the given order
+
+    Every file is written before the first one is moved, so readers see
+    the old index or the new one. A file with nothing staged is removed.
+
+    Args:
+        filenames (list): Live index files, e.g. the matrix last
+    """
+    for fn in filenames:
+        if exists(staged_path(fn)):
+            replace(staged_path(fn), fn)
+        elif exists(fn):
+            remove(fn)
+
+
+def index_version(embeddings_fn: str) -> str:
+    """Stamp that changes whenever a build rewrites the matrix or metadata
+
+    Args:
+        embeddings_fn (str): The embedding matrix (.npy)
+
+    Returns:
+        str: Size and modification time of the matrix and its metadata
+    """
+    files = [stat(fn) for fn in (embeddings_fn, metadata_path(embeddings_fn))]
+    return ' '.join(f'{x.st_size}:{x.st_mtime_ns}' for x in files)
+
+
+def write_embeddings(filename: str, embs, dtype='float32'):
+    """Write vectors as a contiguous .npy matrix
+
+    Args:
+        filename (str): Destination .npy file
+        embs (np.ndarray): #narratives x #dims vectors
+        dtype (str, optional): Storage precision. Defaults to 'float32'.
+    """
+    out = np.lib.format.open_memmap(filename, mode='w+',
+                                    dtype=np.dtype(dtype),
+                                    shape=embs.shape)
+    out[:] = embs
+    out.flush()
+    del out
+
+
+def read_embeddings(filename: str) -> np.memmap:
+    """Memory-map the embedding matrix read-only
+
+    Args:
+        filename (str): The .npy file written by `write_embeddings`
+
+    Returns:
+        np.memmap: #narratives x #dims matrix backed by the file
+    """
+    return np.load(filename, mmap_mode='r')
+
+
+def write_metadata(filename: str, df: pd.DataFrame):
+    """Write the row -> raw data file mapping for the embedding matrix
+
+    Args:
+        filename (str): Destination pickle
+        df (pd.DataFrame): One row per embedding with source, filename, row
+            and, if known, the FILTERS columns
+    """
+    columns = ['source', 'filename', 'row'] + [c for c in FILTERS if c in df]
+    df = df[columns].reset_index(drop=True)
+    df = df.astype({c: 'category' for c in ('source', 'filename',
+                                            'categories') if c in df})
+    df.to_pickle(filename)
+
+
+def read_metadata(filename: str) -> pd.DataFrame:
+    return pd.read_pickle(filename)
+
+
+def _category_mask(column: pd.Series, keep) -> np.ndarray:
+    """Evaluate keep once per distinct value of a categorical column"""
+    hit = np.array([bool(keep(c)) for c in column.cat.categories] + [False])
+    return hit[column.cat.codes.to_numpy()]  # code -1 (missing) -> False
+
+
+def _in_categories(value: str, categories: set) -> bool:
+    """Whether any of the space-separated categories of a row is wanted,
+    either exactly (cs.LG) or by archive (cs matches cs.LG, cs.AI)"""
+    return any(c in categories or c.split('.')[0] in categories
+               for c in str(value).split())
+
+
+def _wanted(categories) -> set:
+    """Categories and archives asked for, with cs.* read as cs"""
+    return {c[:-2] if c.endswith('.*') else c for c in categories}
+
+
+def filter_mask(metadata: pd.DataFrame, since=None, categories=None,
+                feeds=None):
+    """Rows of the index that satisfy every given restriction
+
+    Args:
+        metadata (pd.DataFrame): From `read_metadata`
+        since (str, optional): Earliest posted date, e.g. 2021 or 2021-06-01
+        categories (List[str], optional): Subject categories or archives,
+            e.g. ['cs.LG', 'stat.ML'] or ['cs']; any one of them matches
+        feeds (List[str], optional): Sources such as ARXIV or NSF
+
+    Returns:
+        Optional[np.ndarray]: Boolean mask over the matrix rows, or None
+            when nothing is restricted
+    """
+    masks = []
+    if (since or categories) and not set(FILTERS) <= set(metadata):
+        raise ValueError('The index has no dates or categories; rebuild it '
+                         'with src/compute_embeddings.py')
+    if since:
+        masks.append((metadata.posted >= pd.Timestamp(since)).to_numpy())
+    if categories:
+        wanted = _wanted(categories)
+        masks.append(_category_mask(metadata.categories,
+                                    lambda x: _in_categories(x, wanted)))
+    if feeds:
+        wanted = {f.upper() for f in feeds}
+        masks.append(_category_mask(metadata.source,
+                                    lambda x: x.upper() in wanted))
+    if not masks:
+        return None
+    return np.logical_and.reduce(masks)
+
+
+def normalize(embs: np.ndarray) -> np.ndarray:
+    """L2-normalize rows in place so cosine similarity is a dot product
+
+    Args:
+        embs (np.ndarray): #narratives x #dims float array
+
+    Returns:
+        np.ndarray: The same array with unit-length rows
+    """
+    norms = np.linalg.norm(embs, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    embs /= norms
+    return embs
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, best first, in O(n)
+
+    Args:
+        scores (np.ndarray): One score per narrative, or #narratives x
+            #queries to select for every query (column) at once
+        k (int): Number of indices to return
+
+    Returns:
+        np.ndarray: Indices into scores sorted by descending score along
+            the first axis, shape (k,) or (k, #queries)
+    """
+    n = scores.shape[0]
+    k = min(k, n)
+    if k <= 0:
+        return np.empty((0,)+scores.shape[1:], dtype=np.int64)
+    if k < n:
+        idx = np.argpartition(scores, n - k, axis=0)[n - k:]
+    else:
+        idx = np.broadcast_to(np.arange(n).reshape((n,)+(1,)*(scores.ndim-1)),
+                              scores.shape).copy()
+    order = np.argsort(-np.take_along_axis(scores, idx, axis=0),
+                       axis=0, kind='stable')
+    return np.take_along_axis(idx, order, axis=0)
+
+
+def file_digest(filename: str) -> str:
+    """Content hash of a raw shard"""
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def text_digests(texts) -> list:
+    """Hash of every description, used to drop duplicates across shards"""
+    return [hashlib.sha1(str(t).encode()).hexdigest() for t in texts]
+
+
+def title_keys(titles) -> list:
+    """Titles lowercased with punctuation and spacing dropped, or None"""
+    keys = pd.Series(list(titles), dtype=object).astype(str).str.lower()
+    keys = keys.str.replace(r'[\W_]+', ' ', regex=True).str.strip()
+    return [k if k and k not in ('nan', 'none') else None for k in keys]
+
+
+def id_keys(sources, ids) -> list:
+    """Feed and id of each row, without an arXiv version suffix, or None"""
+    return [None if i is None or i != i or str(i) in ('', 'NA')
+            else f'{s}:{re.sub(r"v[0-9]+$", "", str(i).strip())}'
+            for s, i in zip(sources, ids)]
+
+
+def read_manifest(idir: str, model: str) -> dict:
+    """Shard hashes of the parts already embedded with this model
+
+    Args:
+        idir (str): Index directory
+        model (str): Sentence transformer the parts must come from
+
+    Returns:
+        dict: {'model': model, 'format': FORMAT,
+            'shards': {shard basename: sha256}}
+    """
+    fn = join(idir, MANIFEST)
+    if exists(fn):
+        with open(fn) as f:
+            manifest = json.load(f)
+        if manifest.get('model') == model \
+                and manifest.get('format', 1) == FORMAT:
+            return manifest
+    return {'model': model, 'format': FORMAT, 'shards': {}}
+
+
+def write_manifest(idir: str, manifest: dict):
+    with open(join(idir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def part_paths(idir: str, shard_fn: str):
+    """Vectors, metadata and records files of one shard's part"""
+    stem = join(idir, PARTS, basename(shard_fn))
+    return f'{stem}.npy', f'{stem}.pkl', f'{stem}.records.pkl'
+
+
+def create_part_vectors(idir: str, shard_fn: str, shape) -> np.memmap:
+    """Writable memory map that one shard's vectors are encoded into
+
+    Args:
+        idir (str): Index directory
+        shard_fn (str): Raw shard the rows come from
+        shape (Tuple[int, int]): #rows x #dims
+
+    Returns:
+        np.memmap: float32 matrix backed by the part's .npy file
+    """
+    return np.lib.format.open_memmap(part_paths(idir, shard_fn)[0],
+                                     mode='w+', dtype=np.float32,
+                                     shape=shape)
+
+
+def write_part(idir: str, shard_fn: str, df: pd.DataFrame, records: list):
+    """Store metadata and records of one shard once its vectors are written
+
+    Args:
+        idir (str): Index directory
+        shard_fn (str): Raw shard the rows came from
+        df (pd.DataFrame): source, filename, row, digest, FILTERS and
+            KEYS columns of each row
+        records (list): to_dict fields of each row
+    """
+    _, metadata_fn, records_fn = part_paths(idir, shard_fn)
+    df[['source', 'filename', 'row', 'digest'] + FILTERS + KEYS].reset_index(
+        drop=True).to_pickle(metadata_fn)
+    pd.to_pickle(records, records_fn)
+
+
+def remove_part(idir: str, shard_fn: str):
+    for fn in part_paths(idir, shard_fn):
+        if exists(fn):
+            remove(fn)
+
+
+def merge_parts(idir: str, shards: list, dtype='float32',
+                partition=False) -> pd.DataFrame:
+    """Merge shard parts into the embedding matrix, dropping duplicates
+
+    Duplicate descriptions keep their last occurrence in shard order.
+    Rows are copied one part at a time into the staged matrix; the live
+    one is untouched until `install`, so running searches keep a valid map.
+
+    Args:
+        idir (str): Index directory
+        shards (list): Raw shards, in index order
+        dtype (str, optional): Storage precision. Defaults to 'float32'.
+        partition (bool, optional): Sort rows by `partition_names` so each
+            partition is one contiguous range. Defaults to False.
+
+    Returns:
+        pd.DataFrame: Metadata of the merged rows, plus the part and
+            part_row each matrix row was copied from (and its partition)
+    """
+    parts = [pd.read_pickle(part_paths(idir, fn)[1]).assign(
+                part=i, part_row=lambda x: x.index)
+             for i, fn in enumerate(shards)]
+    df = pd.concat(parts, ignore_index=True)
+    df = df.drop_duplicates(subset=['digest'], keep='last', ignore_index=True)
+    if partition:
+        df['partition'] = partition_names(df)
+        df = df.sort_values('partition', kind='stable', ignore_index=True)
+    first = np.load(part_paths(idir, shards[df.part.iloc[0]])[0],
+                    mmap_mode='r')
+    out = np.lib.format.open_memmap(staged_path(embeddings_path(idir)),
+                                    mode='w+', dtype=np.dtype(dtype),
+                                    shape=(len(df), first.shape[1]))
+    for i, rows in df.groupby('part', sort=True).part_row:
+        vectors = np.load(part_paths(idir, shards[i])[0], mmap_mode='r')
+        out[rows.index.to_numpy()] = vectors[rows.to_numpy()]
+    out.flush()
+    del out
+    return df
+
+
+def _components(n: int, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Connected components of n rows joined by edges a[i]-b[i]
+
+    Returns:
+        np.ndarray: Smallest row of the component of every row
+    """
+    labels = np.arange(n)
+    while True:
+        low = np.minimum(labels[a], labels[b])
+        new = labels.copy()
+        np.minimum.at(new, a, low)
+        np.minimum.at(new, b, low)
+        new = new[new]  # pointer jumping
+        if np.array_equal(new, labels):
+            return labels
+        labels = new
+
+
+def _key_edges(keys: pd.Series):
+    """Edges from each row to the first row with the same (non-null) key"""
+    codes = pd.factorize(keys)[0]
+    rows = np.flatnonzero(codes >= 0)
+    first = pd.Series(rows).groupby(codes[rows]).transform('min').to_numpy()
+    return rows, first
+
+
+def duplicate_groups(df: pd.DataFrame, embs: np.ndarray, pairs=None,
+                     title_threshold=TITLE_THRESHOLD) -> np.ndarray:
+    """Group rows that are the same paper
+
+    Rows with the same feed id (any arXiv version) are one paper. Rows with
+    the same normalized title are one paper if their vectors are also at
+    least title_threshold similar, so distinct papers titled "Erratum" or
+    "Reply" stay apart. Near-duplicate vector pairs join groups too.
+
+    Args:
+        df (pd.DataFrame): Metadata from `merge_parts`
+        embs (np.ndarray): The merged matrix
+        pairs (np.ndarray, optional): #pairs x 2 near-duplicate rows
+        title_threshold (float, optional): Defaults to TITLE_THRESHOLD.
+
+    Returns:
+        np.ndarray: Group label (smallest row of the group) of every row
+    """
+    a, b = _key_edges(df.id_key)
+    ta, tb = _key_edges(df.title_key)
+    similar = np.empty(len(ta), dtype=bool)
+    for start in range(0, len(ta), BLOCK):
+        x = np.asarray(embs[ta[start:start+BLOCK]], dtype=np.float32)
+        y = np.asarray(embs[tb[start:start+BLOCK]], dtype=np.float32)
+        similar[start:start+BLOCK] = (x*y).sum(axis=1) >= title_threshold
+    a, b = np.r_[a, ta[similar]], np.r_[b, tb[similar]]
+    if pairs is not None and len(pairs):
+        a, b = np.r_[a, pairs[:, 0]], np.r_[b, pairs[:, 1]]
+    return _components(len(df), a.astype(np.int64), b.astype(np.int64))
+
+
+def deduplicate(idir: str, df: pd.DataFrame, groups: np.ndarray,
+                dtype='float32'):
+    """Keep the canonical (latest posted, then largest digest) row of every
+    duplicate group in the matrix, whatever the order of the shards
+
+    Args:
+        idir (str): Index directory with the staged matrix
+        df (pd.DataFrame): Metadata from `merge_parts`
+        groups (np.ndarray): From `duplicate_groups`
+        dtype (str, optional): Storage precision. Defaults to 'float32'.
+
+    Returns:
+        Tuple[pd.DataFrame, dict]: Metadata of the kept rows, and
+            kept row -> [(part, part_row)] of its alternates
+    """
+    order = df[['posted', 'digest']].assign(group=groups,
+                                             pos=np.arange(len(df)))
+    order = order.sort_values(['group', 'posted', 'digest'],
+                              na_position='first', kind='stable')
+    canonical = order.groupby('group').pos.last()
+    keep = np.zeros(len(df), dtype=bool)
+    keep[canonical.to_numpy()] = True
+    if keep.all():
+        return df, {}
+    drop = np.flatnonzero(~keep)
+    owners = (np.cumsum(keep) - 1)[canonical.loc[groups[drop]].to_numpy()]
+    alternates = {}
+    for owner, part, part_row in zip(owners, df.part.to_numpy()[drop],
+                                     df.part_row.to_numpy()[drop]):
+        alternates.setdefault(int(owner), []).append((int(part),
+                                                      int(part_row)))
+    staged_fn = staged_path(embeddings_path(idir))
+    embs = read_embeddings(staged_fn)
+    rows = np.flatnonzero(keep)
+    tmp_fn = staged_path(staged_fn)
+    out = np.lib.format.open_memmap(tmp_fn, mode='w+',
+                                    dtype=np.dtype(dtype),
+                                    shape=(len(rows), embs.shape[1]))
+    for start in range(0, len(rows), BLOCK):
+        out[start:start+BLOCK] = embs[rows[start:start+BLOCK]]
+    out.flush()
+    del out, embs
+    replace(tmp_fn, staged_fn)
+    return df[keep].reset_index(drop=True), alternates
+
+
+def partition_names(df: pd.DataFrame) -> np.ndarray:
+    """Partition of every row: its primary (first listed) category, e.g.
+    cs.LG for arXiv, or its feed for sources without categories"""
+    primary = df.categories.astype(object).str.split(n=1).str[0]
+    return np.where(primary.notna(), primary, df.source.astype(str))
+
+
+def partitions_path(idir: str) -> str:
+    return join(idir, PARTITIONS)
+
+
+def write_partitions(filename: str, df: pd.DataFrame):
+    """List the row range of each partition of a partitioned matrix
+
+    Args:
+        filename (str): Destination JSON, staged for `install`
+        df (pd.DataFrame): Metadata from `merge_parts(partition=True)`,
+            or without a partition column to drop the listing
+    """
+    if exists(filename):
+        remove(filename)  # left by an interrupted build
+    if 'partition' not in df:
+        return  # matrix is no longer sorted by partition: nothing staged
+    names = df.partition.to_numpy()
+    starts = np.flatnonzero(np.r_[True, names[1:] != names[:-1]])
+    stops = np.r_[starts[1:], len(names)]
+    partitions = {str(names[a]): [int(a), int(b)]
+                  for a, b in zip(starts, stops)}
+    with open(filename, 'w') as f:
+        json.dump(partitions, f, indent=1)
+
+
+def read_partitions(embeddings_fn: str):
+    """Row ranges of the partitions, or None for an unpartitioned index
+
+    Args:
+        embeddings_fn (str): The embedding matrix
+
+    Returns:
+        Optional[dict]: partition name -> [start, stop)
+    """
+    fn = partitions_path(dirname(embeddings_fn))
+    if not exists(fn):
+        return None
+    with open(fn) as f:
+        return json.load(f)
+
+
+def select_partitions(partitions: dict, scope) -> list:
+    """Row ranges of the partitions in scope, adjacent ranges coalesced
+
+    Args:
+        partitions (dict): From `read_partitions`
+        scope (List[str]): Categories (cs.LG), archives (cs, cs.*) or
+            feeds (NSF) whose partitions to scan
+
+    Returns:
+        List[Tuple[int, int]]: [start, stop) row ranges in matrix order
+    """
+    wanted = _wanted(scope)
+    wanted |= {c.upper() for c in wanted}  # feeds are upper case
+    ranges = []
+    for start, stop in sorted(r for name, r in partitions.items()
+                              if _in_categories(name, wanted)):
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((start, stop))
+    return ranges
+
+
+def split_rows(n: int, parts: int, part: int) -> tuple:
+    """Rows of one of `parts` near-equal slices of the matrix
+
+    Args:
+        n (int): Rows in the matrix
+        parts (int): Number of slices, e.g. partition workers
+        part (int): Slice number, 0 to parts-1
+
+    Returns:
+        Tuple[int, int]: [start, stop) rows of the slice
+    """
+    if not 0 <= part < parts:
+        raise ValueError(f'Partition {part} of {parts} does not exist')
+    return n*part//parts, n*(part + 1)//parts
+
+
+def clip_ranges(ranges: list, start: int, stop: int) -> list:
+    """The parts of row ranges that fall in [start, stop)"""
+    clipped = [(max(a, start), min(b, stop)) for a, b in ranges]
+    return [(a, b) for a, b in clipped if a < b]
+
+
+def iter_part_records(idir: str, shards: list, df: pd.DataFrame,
+                      alternates=None):
+    """Records of the merged rows, one part in memory at a time
+
+    Args:
+        idir (str): Index directory
+        shards (list): Raw shards, in index order
+        df (pd.DataFrame): Metadata returned by `merge_parts`/`deduplicate`
+        alternates (dict, optional): From `deduplicate`; their URLs are
+            added to the records as Alternates
+
+    Yields:
+        Tuple[int, dict]: Embedding id and its to_dict fields
+    """
+    urls = {}
+    wanted = pd.DataFrame([x for v in (alternates or {}).values() for x in v],
+                          columns=['part', 'part_row'])
+    for i, rows in wanted.groupby('part', sort=True):
+        records = pd.read_pickle(part_paths(idir, shards[i])[2])
+        for part_row in rows.part_row:
+            urls[(i, part_row)] = records[part_row]['URL']
+    for i, rows in df.groupby('part', sort=True):
+        records = pd.read_pickle(part_paths(idir, shards[i])[2])
+        for idx, part_row in zip(rows.index, rows.part_row):
+            record = records[part_row]
+            if idx in (alternates or {}):
+                record = {**record, 'Alternates': [urls[x] for x
+                                                   in alternates[idx]]}
+            yield idx, record
@@ -0,0 +1,316 @@
+"""
+Lexical (BM25) inverted index over the titles and descriptions.
+
+Every record in records.sqlite (the title and the TARGET description
+column of its feed, e.g. the arXiv abstract) is tokenized into lower-case
+alphanumeric terms. Each term's posting list holds the matrix rows that
+contain it, delta-encoded as variable-byte integers, and their term
+frequencies. Lists are memory-mapped, so a query reads only the lists of
+its own terms.
+
+The build streams the records and sorts postings in runs of
+DOCS_PER_RUN rows, then merges the runs a block of terms at a time, so
+memory is bounded by a run rather than the corpus.
+
+Run as a script to print the BM25 top k of a query:
+    python src/lexical.py ./index "graph neural network PDE solver" -k 10
+"""
+import json
+import re
+from argparse import ArgumentParser
+from collections import Counter
+from os import makedirs
+from os.path import dirname, exists, getsize, join
+from shutil import rmtree
+from time import perf_counter
+from typing import Iterable, Tuple
+import numpy as np
+try:
+    from src import index as INDEX
+except ImportError:  # run from src/, as compute_embeddings.py and the CLI are
+    import index as INDEX
+
+LEXICAL = 'lexical'
+FORMAT = 1
+K1 = 1.2
+B = 0.75
+DOCS_PER_RUN = 100000  # rows whose postings are sorted in memory at once
+TERMS_PER_MERGE = 65536  # terms merged from the runs at once
+MAX_TF = 255  # term frequencies are stored in one byte
+STOPWORDS = frozenset('an and are as at be by for from has have in is it its '
+                      'of on or that the this to was we were which with'
+                      .split())
+TOKEN = re.compile(r'[a-z0-9]+')
+
+
+def lexical_path(embeddings_fn: str) -> str:
+    """The lexical index always lives next to the embedding matrix"""
+    return join(dirname(embeddings_fn), LEXICAL)
+
+
+def tokenize(text) -> list:
+    """Lower-case alphanumeric terms of a text, without stopwords"""
+    return [t for t in TOKEN.findall(str(text).lower())
+            if len(t) > 1 and t not in STOPWORDS]
+
+
+def vbyte_encode(values: np.ndarray) -> np.ndarray:
+    """Variable-byte code: 7 bits per byte, high bit set on the last byte
+
+    Args:
+        values (np.ndarray): Non-negative integers below 2**35
+
+    Returns:
+        np.ndarray: uint8 code of all values, in order
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28):
+        nbytes += values >= (1 << shift)
+    starts = np.cumsum(nbytes) - nbytes
+    out = np.empty(int(nbytes.sum()), dtype=np.uint8)
+    for j in range(int(nbytes.max(initial=0))):
+        has = nbytes > j
+        group = (values[has] >> np.uint64(7*j)) & np.uint64(0x7f)
+        last = (nbytes[has] == j + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[has] + j] = group | last
+    return out
+
+
+def vbyte_decode(data: np.ndarray) -> np.ndarray:
+    """Inverse of vbyte_encode"""
+    data = np.asarray(data, dtype=np.uint64)
+    if not len(data):
+        return np.empty(0, dtype=np.uint64)
+    stops = np.flatnonzero(data & np.uint64(0x80))
+    starts = np.concatenate(([0], stops[:-1] + 1))
+    position = np.arange(len(data)) - np.repeat(starts, stops - starts + 1)
+    shifts = np.uint64(7)*position.astype(np.uint64)
+    values = (data & np.uint64(0x7f)) << shifts
+    return np.add.reduceat(values, starts)
+
+
+def _write_run(runs_dir: str, number: int, terms, docs, tfs) -> str:
+    """Save one run of postings sorted by term and row"""
+    terms = np.asarray(terms, dtype=np.uint32)
+    docs = np.asarray(docs, dtype=np.int64)
+    order = np.lexsort((docs, terms))
+    prefix = join(runs_dir, f'run{number:04d}')
+    np.save(f'{prefix}_terms.npy', terms[order])
+    np.save(f'{prefix}_docs.npy', docs[order])
+    np.save(f'{prefix}_tfs.npy', np.asarray(tfs, dtype=np.uint8)[order])
+    return prefix
+
+
+def build_lexical(ldir: str, texts: Iterable[Tuple[int, str]], n_docs: int):
+    """Write the inverted index of the texts of every matrix row
+
+    Args:
+        ldir (str): Destination directory, from lexical_path
+        texts (Iterable[Tuple[int, str]]): (matrix row, text) pairs
+        n_docs (int): Rows in the matrix
+    """
+    if exists(ldir):
+        rmtree(ldir)
+    runs_dir = join(ldir, 'runs')
+    makedirs(runs_dir)
+    vocabulary = {}  # term -> id in order of first appearance
+    lengths = np.zeros(n_docs, dtype=np.uint32)
+    runs, terms, docs, tfs, in_run = [], [], [], [], 0
+    for doc, text in texts:
+        tokens = tokenize(text)
+        lengths[doc] = len(tokens)
+        for term, tf in Counter(tokens).items():
+            terms.append(vocabulary.setdefault(term, len(vocabulary)))
+            docs.append(doc)
+            tfs.append(min(tf, MAX_TF))
+        in_run += 1
+        if in_run == DOCS_PER_RUN:
+            runs.append(_write_run(runs_dir, len(runs), terms, docs, tfs))
+            terms, docs, tfs, in_run = [], [], [], 0
+    if terms:
+        runs.append(_write_run(runs_dir, len(runs), terms, docs, tfs))
+    del terms, docs, tfs
+    runs = [tuple(np.load(f'{prefix}_{name}.npy', mmap_mode='r')
+                  for name in ('terms', 'docs', 'tfs')) for prefix in runs]
+    n_terms = len(vocabulary)
+    df = np.zeros(n_terms, dtype=np.int64)
+    nbytes = np.zeros(n_terms, dtype=np.int64)
+    out_tfs = np.lib.format.open_memmap(
+        join(ldir, 'tfs.npy'), mode='w+', dtype=np.uint8,
+        shape=(sum(len(run[0]) for run in runs),))
+    written = 0
+    with open(join(ldir, 'postings.bin'), 'wb') as postings:
+        for t0 in range(0, n_terms, TERMS_PER_MERGE):
+            t1 = min(t0 + TERMS_PER_MERGE, n_terms)
+            parts = []
+            for run_terms, run_docs, run_tfs in runs:
+                a, b = np.searchsorted(run_terms, [t0, t1])
+                parts.append((run_terms[a:b], run_docs[a:b], run_tfs[a:b]))
+            block_terms = np.concatenate([p[0] for p in parts])
+            block_docs = np.concatenate([p[1] for p in parts])
+            order = np.lexsort((block_docs, block_terms))
+            block_terms = block_terms[order]
+            block_docs = block_docs[order]
+            counts = np.bincount(block_terms - t0, minlength=t1 - t0)
+            gaps = block_docs.copy()
+            gaps[1:] -= block_docs[:-1]
+            first = np.cumsum(counts) - counts  # first posting of each term
+            gaps[first] = block_docs[first]
+            code = vbyte_encode(gaps)
+            postings.write(code.tobytes())
+            ends = np.flatnonzero(code & 0x80)  # last byte of every value
+            value_ends = ends[np.cumsum(counts) - 1]
+            nbytes[t0:t1] = np.diff(np.concatenate(([-1], value_ends)))
+            df[t0:t1] = counts
+            out_tfs[written:written+len(order)] = \
+                np.concatenate([p[2] for p in parts])[order]
+            written += len(order)
+    out_tfs.flush()
+    del out_tfs, runs
+    rmtree(runs_dir)
+    sorted_terms = sorted(vocabulary)  # ASCII, so byte order
+    blob = '\n'.join(sorted_terms).encode()
+    with open(join(ldir, 'terms.bin'), 'wb') as f:
+        f.write(blob)
+    term_offsets = np.zeros(n_terms + 1, dtype=np.int64)
+    term_offsets[1:] = np.cumsum([len(t) + 1 for t in sorted_terms])
+    np.save(join(ldir, 'term_offsets.npy'), term_offsets)
+    np.save(join(ldir, 'term_ids.npy'),
+            np.array([vocabulary[t] for t in sorted_terms], dtype=np.int64))
+    np.save(join(ldir, 'df.npy'), df.astype(np.uint32))
+    np.save(join(ldir, 'byte_offsets.npy'),
+            np.concatenate(([0], np.cumsum(nbytes))))
+    np.save(join(ldir, 'doc_lengths.npy'), lengths)
+    with open(join(ldir, 'lexical.json'), 'w') as f:
+        json.dump({'format': FORMAT, 'docs': n_docs, 'vocabulary': n_terms,
+                   'avgdl': float(lengths.mean()) if n_docs else 0.0,
+                   'k1': K1, 'b': B}, f)
+
+
+def remove_lexical(ldir: str):
+    """Drop a lexical index that no longer matches the matrix"""
+    if exists(ldir):
+        rmtree(ldir)
+
+
+def read_lexical(ldir: str) -> dict:
+    """Memory-map a lexical index written by build_lexical
+
+    Args:
+        ldir (str): Directory from lexical_path
+
+    Returns:
+        dict: Parameters and memory-mapped arrays for `search`
+    """
+    if not exists(join(ldir, 'lexical.json')):
+        raise FileNotFoundError(f'No lexical index in {ldir}; build it with '
+                                f'src/compute_embeddings.py --lexical')
+    with open(join(ldir, 'lexical.json')) as f:
+        lexical = json.load(f)
+    if lexical['format'] != FORMAT:
+        raise ValueError(f'{ldir} has lexical format {lexical["format"]}; '
+                         f'rebuild it with src/compute_embeddings.py --lexical')
+
+    def mapped(name, dtype=np.uint8):
+        fn = join(ldir, name)
+        if name.endswith('.npy'):
+            return np.load(fn, mmap_mode='r')
+        if getsize(fn) == 0:  # np.memmap refuses empty files
+            return np.empty(0, dtype=dtype)
+        return np.memmap(fn, dtype=dtype, mode='r')
+    for name in ('terms.bin', 'postings.bin', 'term_offsets.npy',
+                 'term_ids.npy', 'df.npy', 'byte_offsets.npy', 'tfs.npy',
+                 'doc_lengths.npy'):
+        lexical[name.split('.')[0]] = mapped(name)
+    lexical['posting_offsets'] = np.concatenate(
+        ([0], np.cumsum(lexical['df'], dtype=np.int64)))
+    return lexical
+
+
+def find_term(lexical: dict, term: str) -> int:
+    """Id of a term by binary search of the sorted terms, or -1"""
+    key = term.encode()
+    offsets, blob = lexical['term_offsets'], lexical['terms']
+    lo, hi = 0, len(offsets) - 1
+    while lo < hi:
+        mid = (lo + hi)//2
+        found = blob[offsets[mid]:offsets[mid+1]-1].tobytes()
+        if found < key:
+            lo = mid + 1
+        elif found > key:
+            hi = mid
+        else:
+            return int(lexical['term_ids'][mid])
+    return -1
+
+
+def postings(lexical: dict, term_id: int):
+    """Rows containing a term and its frequency in each
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Row ids (ascending) and frequencies
+    """
+    a, b = lexical['byte_offsets'][term_id:term_id+2]
+    docs = np.cumsum(vbyte_decode(lexical['postings'][a:b])).astype(np.int64)
+    p0, p1 = lexical['posting_offsets'][term_id:term_id+2]
+    return docs, np.asarray(lexical['tfs'][p0:p1], dtype=np.float32)
+
+
+def search(lexical: dict, text: str, k: int, mask=None, ranges=None):
+    """BM25 top k rows for a query
+
+    Args:
+        lexical (dict): From read_lexical
+        text (str): The query (a prompt)
+        k (int): Number of rows to return
+        mask (np.ndarray, optional): Boolean mask of allowed rows
+        ranges (List[Tuple[int, int]], optional): [start, stop) row ranges
+            to search. Defaults to all rows.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Row ids and BM25 scores, best first
+    """
+    n, avgdl = lexical['docs'], lexical['avgdl'] or 1.0
+    k1, b = lexical['k1'], lexical['b']
+    all_docs, all_weights = [], []
+    for term in dict.fromkeys(tokenize(text)):
+        term_id = find_term(lexical, term)
+        if term_id < 0:
+            continue
+        docs, tf = postings(lexical, term_id)
+        idf = np.log(1 + (n - len(docs) + 0.5)/(len(docs) + 0.5))
+        norm = k1*(1 - b + b*lexical['doc_lengths'][docs]/avgdl)
+        all_docs.append(docs)
+        all_weights.append(idf*tf*(k1 + 1)/(tf + norm))
+    if not all_docs:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    docs, inverse = np.unique(np.concatenate(all_docs), return_inverse=True)
+    scores = np.bincount(inverse, weights=np.concatenate(all_weights))
+    keep = np.ones(len(docs), dtype=bool)
+    if mask is not None:
+        keep &= mask[docs]
+    if ranges is not None:
+        in_range = np.zeros(len(docs), dtype=bool)
+        for start, stop in ranges:
+            a, b = np.searchsorted(docs, [start, stop])
+            in_range[a:b] = True
+        keep &= in_range
+    docs, scores = docs[keep], scores[keep]
+    best = INDEX.top_k(scores, k)
+    return docs[best], scores[best].astype(np.float32)
+
+
+if __name__ == "__main__":
+    p = ArgumentParser()
+    p.add_argument('IDIR', help='Index directory with a lexical/ index')
+    p.add_argument('query', help='Terms to search for')
+    p.add_argument('-k', '--k', default=10, type=int)
+    args = p.parse_args()
+    lexical = read_lexical(join(args.IDIR, LEXICAL))
+    tic = perf_counter()
+    ids, scores = search(lexical, args.query, args.k)
+    print(f'{len(ids)} rows in {1000*(perf_counter() - tic):.1f} ms '
+          f'({lexical["docs"]} rows, {lexical["vocabulary"]} terms)')
+    for i, score in zip(ids, scores):
+        print(f'{score:8.3f}  row {i}')
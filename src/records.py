@@ -0,0 +1,90 @@
+"""
+Record store for hydrating search results without re-reading raw shards.
+
+`compute_embeddings.py` writes the `to_dict` fields of every embedded
+narrative into a SQLite table keyed by its row in the embedding matrix,
+so `Experiment.select_results` fetches all top-k records in one lookup.
+"""
+import json
+import sqlite3
+from os import remove
+from os.path import dirname, exists, join
+from typing import Iterable, List, Tuple
+
+RECORDS = 'records.sqlite'
+MAX_PARAMS = 500  # stay under SQLITE_MAX_VARIABLE_NUMBER on old builds
+
+
+def records_path(embeddings_fn: str) -> str:
+    """Records always live next to the embedding matrix"""
+    return join(dirname(embeddings_fn), RECORDS)
+
+
+def _plain(o):
+    """JSON fallback for numpy scalars and other oddities in raw rows"""
+    if hasattr(o, 'item'):
+        return o.item()
+    return str(o)
+
+
+def write_records(filename: str, records: Iterable[Tuple[int, dict]]):
+    """Write (embedding id, to_dict record) pairs to a fresh store
+
+    Args:
+        filename (str): Destination SQLite file
+        records (Iterable[Tuple[int, dict]]): Records keyed by matrix row
+    """
+    if exists(filename):
+        remove(filename)
+    con = sqlite3.connect(filename)
+    con.execute('PRAGMA journal_mode=OFF')
+    con.execute('PRAGMA synchronous=OFF')
+    con.execute('CREATE TABLE records (id INTEGER PRIMARY KEY, record TEXT)')
+    con.executemany('INSERT INTO records VALUES (?, ?)',
+                    ((int(i), json.dumps(r, default=_plain))
+                     for i, r in records))
+    con.commit()
+    con.close()
+
+
+def open_records(filename: str) -> sqlite3.Connection:
+    return sqlite3.connect(f'file:{filename}?mode=ro', uri=True,
+                           check_same_thread=False)
+
+
+def read_records(con: sqlite3.Connection, ids: List[int]) -> List[dict]:
+    """Fetch records for many embedding ids in bulk
+
+    Args:
+        con (sqlite3.Connection): Store opened with `open_records`
+        ids (List[int]): Embedding ids (matrix rows)
+
+    Returns:
+        List[dict]: The records, in the order of ids
+    """
+    ids = [int(i) for i in ids]
+    found = {}
+    for start in range(0, len(ids), MAX_PARAMS):
+        chunk = ids[start:start+MAX_PARAMS]
+        marks = ','.join('?'*len(chunk))
+        found.update(con.execute(
+            f'SELECT id, record FROM records WHERE id IN ({marks})', chunk))
+    return [json.loads(found[i]) for i in ids]
+
+
+def iter_records(filename: str):
+    """Every record of a store, in embedding id order
+
+    Args:
+        filename (str): SQLite file from `write_records`
+
+    Yields:
+        Tuple[int, dict]: Embedding id and its to_dict fields
+    """
+    con = open_records(filename)
+    try:
+        for i, record in con.execute('SELECT id, record FROM records '
+                                     'ORDER BY id'):
+            yield i, json.loads(record)
+    finally:
+        con.close()
@@ -0,0 +1,183 @@
+"""
+Resident search server for Dr. Draft's SOTA Literature Search
+
+`python main.py --serve` loads the model and memory-maps the index once,
+then answers queries over a local Unix socket (or a localhost TCP port).
+`python main.py --connect` forwards the prompt to it instead of loading
+everything again. Requests and replies are one JSON document per line.
+
+A server started with `--part I/N` scans only the I-th of N slices of
+the matrix and answers already encoded prompt vectors with its top k row
+ids and scores, searched the way (exact, ann or quantized) the request
+asks. `python main.py --workers ADDRESS ...` encodes the
+prompt once, scatters it to every partition worker (on this host or
+others) and merges their candidates into the global top k.
+"""
+import json
+import socket
+import socketserver
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from os import lstat, remove
+from os.path import exists
+import pandas as pd
+
+
+def parse_address(address: str):
+    """Interpret an address as host:port or as a Unix socket path
+
+    Args:
+        address (str): e.g. 'localhost:8765' or './index/drdraft.sock'
+
+    Returns:
+        Union[Tuple[str, int], str]: TCP (host, port) or socket path
+    """
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line)
+            try:
+                if 'vectors' in request:  # from a scatter-gather coordinator
+                    hits = self.server.experiment.search_vectors(
+                        request['vectors'], request['k'],
+                        request.get('filters'),
+                        request.get('search', 'exact'),
+                        request.get('nprobe'), request.get('rerank'))
+                    reply = {'hits': [[h.index.tolist(),
+                                       h.similarity.tolist()] for h in hits]}
+                else:
+                    results = self.server.experiment.query(
+                        request['prompt'], request['k'],
+                        request.get('filters'))
+                    reply = {'results': results.to_json(orient='table')}
+            except Exception as e:  # report to the client, keep serving
+                reply = {'error': repr(e)}
+            self.wfile.write((json.dumps(reply)+'\n').encode())
+
+
+class _UnixServer(socketserver.UnixStreamServer):
+    pass
+
+
+class _TCPServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+def _is_socket(path: str) -> bool:
+    try:
+        return stat.S_ISSOCK(lstat(path).st_mode)
+    except FileNotFoundError:
+        return False
+
+
+def _remove_stale_socket(path: str):
+    """Remove a socket left by a server that is gone
+
+    Raises:
+        FileExistsError: The path is not a socket, or a server is
+            listening on it
+    """
+    if not exists(path):
+        return
+    if not _is_socket(path):
+        raise FileExistsError(f'{path} exists and is not a socket; '
+                              f'choose another --serve address')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        try:
+            conn.connect(path)
+        except OSError:  # nobody listening: stale socket
+            remove(path)
+            return
+    raise FileExistsError(f'A server is already listening on {path}')
+
+
+def serve(experiment, address: str):
+    """Answer queries with an already loaded experiment until interrupted
+
+    Args:
+        experiment (sota_search.Experiment): Loaded experiment
+        address (str): Unix socket path or host:port to listen on
+    """
+    addr = parse_address(address)
+    if isinstance(addr, tuple):
+        server = _TCPServer(addr, _Handler)
+    else:
+        _remove_stale_socket(addr)
+        server = _UnixServer(addr, _Handler)
+    server.experiment = experiment
+    print(f' - Serving Dr. Draft on {address} (Ctrl-C to stop)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not isinstance(addr, tuple) and _is_socket(addr):
+            remove(addr)
+
+
+def _request(address: str, request: dict) -> dict:
+    """Send one request to a server and return its reply"""
+    addr = parse_address(address)
+    family = socket.AF_INET if isinstance(addr, tuple) else socket.AF_UNIX
+    with socket.socket(family, socket.SOCK_STREAM) as conn:
+        conn.connect(addr)
+        stream = conn.makefile('rwb')
+        stream.write((json.dumps(request)+'\n').encode())
+        stream.flush()
+        reply = json.loads(stream.readline())
+    if 'error' in reply:
+        raise RuntimeError(f'Dr. Draft server {address} error: '
+                           f'{reply["error"]}')
+    return reply
+
+
+def query(address: str, prompt: str, k: int,
+          filters: dict = None) -> pd.DataFrame:
+    """Ask a running server for the top k results for a prompt
+
+    Args:
+        address (str): Unix socket path or host:port of the server
+        prompt (str): Description of the work you want to do
+        k (int): Number of matches to return
+        filters (dict, optional): since, categories, feeds restrictions
+
+    Returns:
+        pd.DataFrame: The same results `Experiment.results` returns
+    """
+    reply = _request(address, {'prompt': prompt, 'k': k, 'filters': filters})
+    return pd.read_json(StringIO(reply['results']), orient='table')
+
+
+def scatter(addresses, vectors, k: int, filters: dict = None,
+            search: str = 'exact', nprobe: int = None, rerank: int = None):
+    """Search every partition worker for the top k of each prompt vector
+
+    Args:
+        addresses (List[str]): Partition workers (--serve --part I/N)
+        vectors (numpy.ndarray): #prompts x #dims normalized prompts
+        k (int): Number of candidates per prompt and worker
+        filters (dict, optional): since, categories, feeds, scope
+        search (str, optional): exact, ann or quantized, run by every
+            worker whatever it was started with. Defaults to 'exact'.
+        nprobe (int, optional): IVF lists probed with search='ann'
+        rerank (int, optional): Shortlist factor with search='quantized'
+
+    Returns:
+        List[List[pd.DataFrame]]: For each worker, the similarity of its
+            top k rows for each prompt, indexed by row
+    """
+    request = {'vectors': [[float(x) for x in v] for v in vectors],
+               'k': k, 'filters': filters, 'search': search,
+               'nprobe': nprobe, 'rerank': rerank}
+    with ThreadPoolExecutor(len(addresses)) as pool:
+        replies = list(pool.map(lambda a: _request(a, request), addresses))
+    return [[pd.DataFrame({'similarity': scores}, index=ids, dtype='float32')
+             for ids, scores in reply['hits']] for reply in replies]
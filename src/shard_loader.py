@@ -0,0 +1,76 @@
+"""
+Parse raw shards for `compute_embeddings.py`.
+
+The loader processes of an index build run `load_shard`. They are
+spawned, so they import this module and not the build script: only
+pandas and the data classes, not torch or the sentence transformer.
+"""
+from typing import List
+import data as DATA_CLASSES
+import index as INDEX
+
+DESCRIPTION_ATTR = {
+                    'ARXIV': 'abstract'
+                    }
+
+
+def files2objects(files: List[str]):
+    """Convert raw data files to objects.
+
+    Args:
+        files (List[str]): Raw data files named FEED_S000
+
+    Returns:
+        List[obj]: A list of class objects for reading each raw data files
+    """
+    classes = [f.split('/')[-1].split('_')[0] for f in files]
+    zset = zip(files, classes)
+    return [getattr(DATA_CLASSES, c)(f, DESCRIPTION_ATTR[c]) for f, c in zset]
+
+
+def object2records(obj, rows) -> List[dict]:
+    """Convert rows of an object to result records.
+
+    Args:
+        obj: Class object for one raw data file
+        rows (Iterable[int]): Rows to convert
+
+    Returns:
+        List[dict]: to_dict fields of each row
+    """
+    records = []
+    for row in rows:
+        record = obj.to_dict(row, None)
+        del record['Similarity']
+        records.append(record)
+    return records
+
+
+def load_shard(filename: str, columnar=False):
+    """Parse one raw shard into descriptions and result records.
+
+    Runs in a loader process, so parsing overlaps with encoding.
+
+    Args:
+        filename (str): Raw data file named FEED_S000
+        columnar (bool, optional): Also save a Parquet copy of the shard
+
+    Returns:
+        Tuple[pandas.DataFrame, List[dict]]: source, filename, row,
+            description, digest, posted, categories, title and id keys of
+            each row and its to_dict fields
+    """
+    obj = files2objects([filename])[0]
+    if columnar and not obj.has_columnar():
+        try:
+            obj.write_columnar()
+        except Exception as e:  # e.g. mixed types pyarrow cannot store
+            print(f'Warning: no columnar copy of {filename}: {e}')
+    df = obj.get_descriptions()
+    df['digest'] = INDEX.text_digests(df.description)
+    records = object2records(obj, df.row)
+    df['posted'] = obj.get_posted().to_numpy()
+    df['categories'] = obj.get_categories().to_numpy()
+    df['title_key'] = INDEX.title_keys(r['Title'] for r in records)
+    df['id_key'] = INDEX.id_keys(df.source, [r['FeedID'] for r in records])
+    return df, records
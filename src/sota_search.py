@@ -1,17 +1,26 @@
 """
 Module for the state of the art (SOTA) literature search
 """
+import sqlite3
 import textwrap
 import pandas as pd
-import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from threading import Lock
 from os.path import exists
-from os import environ
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
-from transformers import pipeline
+from os import cpu_count, environ
+import numpy as np
+from threadpoolctl import threadpool_limits
 from src import data as DATA
+from src import index as INDEX
+from src import records as RECORDS
+from src import ann as ANN
+from src import cache as CACHE
+from src import lexical as LEXICAL
+from src import tracing as TRACE
+from src import server as SERVER
 from functools import lru_cache
 
 
@@ -20,6 +29,17 @@ N_TIERS = 11
 PRIZES_RGB = [240, 245, 250, 255, 46, 33, 92, 226, 202, 199]
 PRINTMAXCHARS = 80
 PRINTMAXLINES = 12
+QUERIES_PER_PRODUCT = 64  # bounds the #narratives x #queries score matrix
+SHARD_CACHE_SIZE = 32  # parsed raw shards kept by an Experiment
+HYDRATION_WORKERS = 8
+MASK_CACHE_SIZE = 8  # filter masks kept by an Experiment (e.g. a server)
+SCAN_ROWS = 65536  # rows of the matrix scored at once by an exact scan
+SCAN_THREADS = cpu_count() or 1
+SCAN_BYTES = 256*2**20  # scores and row copies of all blocks in flight
+LEXICAL_SEARCHES = ('lexical', 'hybrid', 'prefilter')
+PREFILTER_CANDIDATES = 2000  # BM25 candidates dense-scored by --search prefilter
+FUSION_DEPTH = 100  # dense and BM25 ranks fused by --search hybrid
+RRF_K = 60  # reciprocal rank fusion: 1/(RRF_K + rank)
 TARGET = {'NSF': 'Synopsis',
           'SCS': 'Brief Description',
           'SAM': 'Description',
@@ -31,7 +51,6 @@ TARGET = {'NSF': 'Synopsis',
           'ARXIV': 'abstract'
           }
 DRDRAFT = 'all-mpnet-base-v2'
-DRGIST = 'facebook/bart-large-cnn'
 
 
 def results2console(results: pd.DataFrame, print_summary=False):
@@ -48,6 +67,8 @@ def results2console(results: pd.DataFrame, print_summary=False):
         x = results.iloc[i]
         show_prize_banner(f'{x.Title}', x.Similarity)
         show_one('URL', x['URL'])
+        if isinstance(x.get('Alternates'), list) and x['Alternates']:
+            show_one('Alternates', ', '.join(x['Alternates']))
         description = x['Description']
         show_one('Abstract', description, limit=True)
         
@@ -140,6 +161,18 @@ def description(ds, nearest_neighbors, i):
     show_one(i, raw_data.df.loc[row].Description)
 
 
+@lru_cache(maxsize=None)
+def load_model():
+    """Load the {DRDRAFT} model once per process
+
+    Returns:
+        SentenceTransformer: The prompt encoder
+    """
+    with TRACE.stage('load_model'):
+        from sentence_transformers import SentenceTransformer  # torch: seconds
+        return SentenceTransformer(DRDRAFT)
+
+
 def encode_prompt(prompt):
     """Encode a prompt using the {DRDRAFT} model
 
@@ -149,38 +182,353 @@ def encode_prompt(prompt):
     Returns:
         Array: Vector representation of the prompt
     """
-    model = SentenceTransformer(DRDRAFT)
-    return model.encode([prompt])
+    model = load_model()
+    with TRACE.stage('encode'):
+        return model.encode([prompt])
+
+
+def encode_prompts(prompts):
+    """Encode many prompts in one batch using the {DRDRAFT} model
+
+    Args:
+        prompts (List[str]): The prompts to encode
+
+    Returns:
+        Array: #prompts x #dims vector representations
+    """
+    model = load_model()
+    with TRACE.stage('encode', prompts=len(prompts)):
+        return model.encode(list(prompts), batch_size=64)
 
 def read_narrative_embeddings(filename: str):
     """ Read narrative embeddings from a file
 
     Args:
-        filename (str): The filename to read
+        filename (str): The embedding matrix (.npy) to memory-map
 
     Returns:
-        Pandas.DataFrame: The narrative embeddings
+        Tuple[Pandas.DataFrame, numpy.memmap]: The metadata (source,
+            filename, row) and the narrative embeddings
     """
-    return pd.read_pickle(filename)
+    with TRACE.stage('read_metadata'):
+        metadata = INDEX.read_metadata(INDEX.metadata_path(filename))
+    with TRACE.stage('map_embeddings'):
+        return metadata, INDEX.read_embeddings(filename)
 
-def sort_by_similarity_to_prompt(prompt, embedded_narratives):
+def sort_by_similarity_to_prompt(prompt, embedded_narratives, k=None):
     """ Sort a set of narratives by similarity to a prompt
 
+    The narratives are L2-normalized at index build, so cosine similarity
+    is one matrix-vector product. Only the top k are selected and sorted.
+
     Args:
         prompt (str): The prompt to compare
-        embedded_narratives (pandas.DataFrame): The embedded narratives
+        embedded_narratives (numpy.ndarray): The normalized embedded narratives
+        k (int, optional): Number of candidates to return. Defaults to all.
+
+    Returns:
+        Pandas.DataFrame: The k most similar narratives, indexed by row
+    """
+    return sort_by_similarity_to_prompts([prompt], embedded_narratives, k)[0]
+
+
+@lru_cache(maxsize=None)
+def scan_pool():
+    """Threads scoring blocks of the matrix, shared by every scan
+
+    Returns:
+        ThreadPoolExecutor: SCAN_THREADS workers (BLAS releases the GIL)
+    """
+    return ThreadPoolExecutor(SCAN_THREADS)
+
+
+SCANS = {'running': 0, 'limits': None}  # pooled scans sharing the BLAS limit
+SCANS_LOCK = Lock()
+
+
+@contextmanager
+def one_blas_thread():
+    """ Run BLAS on one thread while scan_pool scores blocks
+
+    The pool already runs a product on every core; BLAS threads on top of
+    it would oversubscribe them. The limit is process-wide, so concurrent
+    scans share it and the last one to finish restores the old setting.
+    """
+    with SCANS_LOCK:
+        if SCANS['running'] == 0:
+            SCANS['limits'] = threadpool_limits(1, user_api='blas')
+        SCANS['running'] += 1
+    try:
+        yield
+    finally:
+        with SCANS_LOCK:
+            SCANS['running'] -= 1
+            if SCANS['running'] == 0:
+                SCANS['limits'].restore_original_limits()
+                SCANS['limits'] = None
+
+
+def scan_rows(embedded_narratives, chunk, mask=None) -> int:
+    """ Rows per block, so SCAN_THREADS blocks in flight fit SCAN_BYTES
+
+    Every block holds a float32 score per row and prompt. A mask copies
+    the allowed rows out of the map, and a float16 matrix is upcast to a
+    float32 copy, so those blocks are smaller.
+
+    Returns:
+        int: At most SCAN_ROWS
+    """
+    dims = embedded_narratives.shape[1]
+    row_bytes = 4*len(chunk)
+    if mask is not None:
+        row_bytes += embedded_narratives.dtype.itemsize*dims
+    if embedded_narratives.dtype != np.float32:
+        row_bytes += 4*dims
+    return max(1, min(SCAN_ROWS, SCAN_BYTES//(SCAN_THREADS*row_bytes)))
+
+
+def _scan_block(embedded_narratives, chunk, k, start, stop, mask=None):
+    """ Exact top k of rows [start, stop) for a chunk of prompt vectors
+
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray]: k x #prompts row ids and
+            similarities, best first
+    """
+    if mask is None:
+        rows = None
+        block = embedded_narratives[start:stop]
+    else:  # copy only the allowed rows out of the map
+        rows = start + np.flatnonzero(mask[start:stop])
+        block = embedded_narratives[rows]
+    # float32 BLAS even for a float16 matrix; converts one block at a time
+    similarity = np.asarray(block, dtype=np.float32).dot(chunk.T)
+    best = INDEX.top_k(similarity, k)
+    ids = start + best if rows is None else rows[best]
+    return ids, np.take_along_axis(similarity, best, axis=0)
+
+
+def _scan(embedded_narratives, chunk, k, ranges, mask=None):
+    """ Exact top k of the row ranges, scanned in blocks on scan_pool
+
+    Each block of `scan_rows` rows is scored and reduced to its own top
+    k, and the per-block candidates are merged, so memory does not grow
+    with the number of narratives or the number of cores.
+
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray]: k x #prompts row ids and
+            similarities, best first
+    """
+    rows = scan_rows(embedded_narratives, chunk, mask)
+    blocks = [(a, min(a + rows, stop))
+              for start, stop in ranges
+              for a in range(start, stop, rows)]
+    if not blocks:  # nothing in scope
+        blocks = [(0, 0)]
+    with TRACE.stage('score', blocks=len(blocks)):
+        if len(blocks) == 1:
+            hits = [_scan_block(embedded_narratives, chunk, k, *blocks[0],
+                                mask)]
+        else:
+            with one_blas_thread():
+                hits = list(scan_pool().map(
+                    lambda x: _scan_block(embedded_narratives, chunk, k, *x,
+                                          mask), blocks))
+    ids, scores = hits[0]
+    if len(hits) > 1:  # merge the top k of every block
+        with TRACE.stage('top_k'):
+            ids = np.concatenate([h[0] for h in hits])
+            scores = np.concatenate([h[1] for h in hits])
+            best = INDEX.top_k(scores, k)
+            ids = np.take_along_axis(ids, best, axis=0)
+            scores = np.take_along_axis(scores, best, axis=0)
+    return ids, scores
+
+
+def sort_by_similarity_to_prompts(prompts, embedded_narratives, k=None,
+                                  approximate=None, mask=None, ranges=None):
+    """ Sort a set of narratives by similarity to each of many prompts
+
+    Prompts are encoded as one batch and scored with one matrix-matrix
+    product per QUERIES_PER_PRODUCT prompts; top k is selected for all
+    of them at once. The exact scan reads the memory-mapped matrix in
+    blocks on a thread pool and merges their top k, so it needs constant
+    memory. An approximate search (IVF lists or quantized codes)
+    replaces the exact scan when given. With a mask, only the allowed
+    narratives are scored, so k candidates always satisfy it. With row
+    ranges (partitions of the index), only those rows are scanned.
+
+    Args:
+        prompts (List[str]): The prompts to compare
+        embedded_narratives (numpy.ndarray): The normalized embedded narratives
+        k (int, optional): Number of candidates per prompt. Defaults to all.
+        approximate (Callable, optional): search(prompt vector, k, mask=)
+            that returns (ids, similarities), e.g. a partial of ANN.search
+        mask (numpy.ndarray, optional): Boolean mask of allowed narratives,
+            from INDEX.filter_mask
+        ranges (List[Tuple[int, int]], optional): [start, stop) row ranges
+            to scan, from INDEX.select_partitions. Defaults to all rows.
+
+    Returns:
+        List[Pandas.DataFrame]: The k most similar narratives for each
+            prompt, indexed by row
+    """
+    embedded_prompts = INDEX.normalize(
+        np.asarray(encode_prompts(prompts), dtype=np.float32))
+    return sort_by_similarity_to_vectors(embedded_prompts, embedded_narratives,
+                                         k, approximate, mask, ranges)
+
+
+def sort_by_similarity_to_vectors(embedded_prompts, embedded_narratives,
+                                  k=None, approximate=None, mask=None,
+                                  ranges=None):
+    """ `sort_by_similarity_to_prompts` for already encoded prompts
+
+    Args:
+        embedded_prompts (numpy.ndarray): #prompts x #dims normalized
+            prompt vectors
+        embedded_narratives (numpy.ndarray): The normalized embedded narratives
+        k (int, optional): Number of candidates per prompt. Defaults to all.
+        approximate (Callable, optional): As in sort_by_similarity_to_prompts
+        mask (numpy.ndarray, optional): Boolean mask of allowed narratives
+        ranges (List[Tuple[int, int]], optional): [start, stop) row ranges
+
+    Returns:
+        List[Pandas.DataFrame]: The k most similar narratives for each
+            prompt, indexed by row
+    """
+    if k is None:
+        k = len(embedded_narratives)
+    if approximate is not None:
+        with TRACE.stage('approximate_search',
+                         prompts=len(embedded_prompts)):
+            hits = [approximate(q, k, mask=mask) for q in embedded_prompts]
+        return [pd.DataFrame({'similarity': scores}, index=ids)
+                for ids, scores in hits]
+    if ranges is None:
+        ranges = [(0, len(embedded_narratives))]
+    results = []
+    for start in range(0, len(embedded_prompts), QUERIES_PER_PRODUCT):
+        chunk = embedded_prompts[start:start+QUERIES_PER_PRODUCT]
+        ids, scores = _scan(embedded_narratives, chunk, k, ranges, mask)
+        results += [pd.DataFrame({'similarity': scores[:, j]}, index=ids[:, j])
+                    for j in range(len(chunk))]
+    return results
+
+
+def fuse(rankings, k):
+    """ Reciprocal rank fusion of several rankings of the same narratives
+
+    Args:
+        rankings (List[Pandas.DataFrame]): Similarity of ranked rows, best
+            first, indexed by row
+        k (int): Number of rows to return
+
+    Returns:
+        Pandas.DataFrame: The k rows with the largest sum of
+            1/(RRF_K + rank), with their similarity
+    """
+    fused, similarity = {}, {}
+    for ranking in rankings:
+        for rank, (i, s) in enumerate(ranking.similarity.items(), 1):
+            fused[i] = fused.get(i, 0.0) + 1/(RRF_K + rank)
+            similarity[i] = s
+    ids = sorted(fused, key=lambda i: (-fused[i], i))[:k]
+    return pd.DataFrame({'similarity': [similarity[i] for i in ids]},
+                        index=np.array(ids, dtype=np.int64), dtype='float32')
+
+
+def sort_by_lexical(prompts, embedded_prompts, lexical, embedded_narratives,
+                    k, mode, mask=None, ranges=None):
+    """ Rank narratives with the BM25 index, alone or with the dense scores
+
+    'lexical' ranks by BM25. 'prefilter' dense-scores only the
+    PREFILTER_CANDIDATES best BM25 rows, reading just those rows of the
+    memory map. 'hybrid' fuses the BM25 and exact dense rankings (top
+    FUSION_DEPTH of each) by reciprocal rank. The similarity column is
+    always the cosine similarity to the prompt.
+
+    Args:
+        prompts (List[str]): The prompts to compare
+        embedded_prompts (numpy.ndarray): #prompts x #dims normalized
+            prompt vectors
+        lexical (dict): From LEXICAL.read_lexical
+        embedded_narratives (numpy.ndarray): The normalized embedded narratives
+        k (int): Number of candidates per prompt
+        mode (str): 'lexical', 'prefilter' or 'hybrid'
+        mask (numpy.ndarray, optional): Boolean mask of allowed narratives
+        ranges (List[Tuple[int, int]], optional): [start, stop) row ranges
+
+    Returns:
+        List[Pandas.DataFrame]: The k best narratives for each prompt,
+            indexed by row
+    """
+    depth = {'lexical': k, 'prefilter': max(k, PREFILTER_CANDIDATES),
+             'hybrid': max(k, FUSION_DEPTH)}[mode]
+    if mode == 'hybrid':
+        dense = sort_by_similarity_to_vectors(
+            embedded_prompts, embedded_narratives, depth, mask=mask,
+            ranges=ranges)
+    results = []
+    for j, (prompt, vector) in enumerate(zip(prompts, embedded_prompts)):
+        with TRACE.stage('bm25'):
+            ids, _ = LEXICAL.search(lexical, prompt, depth, mask, ranges)
+        with TRACE.stage('score', rows=len(ids)):
+            order = np.argsort(ids)  # read the rows in matrix order
+            similarity = np.empty(len(ids), dtype=np.float32)
+            similarity[order] = np.asarray(
+                embedded_narratives[ids[order]], dtype=np.float32).dot(vector)
+        if mode == 'prefilter':
+            best = INDEX.top_k(similarity, k)
+            ids, similarity = ids[best], similarity[best]
+        hits = pd.DataFrame({'similarity': similarity}, index=ids)
+        if mode == 'hybrid':
+            hits = fuse([dense[j], hits], k)
+        results.append(hits)
+    return results
+
+
+def gather(hits, k):
+    """ Merge the top k of every partition worker into the global top k
+
+    Args:
+        hits (List[List[Pandas.DataFrame]]): From SERVER.scatter, for each
+            worker the similarity of its top k rows for each prompt
+        k (int): Number of candidates per prompt
+
+    Returns:
+        List[Pandas.DataFrame]: The k most similar narratives for each
+            prompt, indexed by row
+    """
+    results = []
+    for per_worker in zip(*hits):
+        candidates = pd.concat(per_worker)  # in worker (row) order
+        best = INDEX.top_k(candidates.similarity.to_numpy(), k)
+        results.append(candidates.iloc[best])
+    return results
+
+
+def read_prompts(filename: str, k: int, title: str):
+    """ Read a batch of queries from a CSV or JSONL file
+
+    Args:
+        filename (str): File with a prompt column and optional title, k
+        k (int): Number of matches for rows without a k
+        title (str): Title for rows without a title
 
     Returns:
-        Pandas.DataFrame: The sorted narratives
+        pd.DataFrame: One query per row with title, prompt, k
     """
-    embedded_prompt = encode_prompt(prompt)
-    similarity = [_[0] for _ in
-                  cosine_similarity(embedded_narratives.iloc[:, 4:],
-                                    embedded_prompt.reshape(1, -1))]
-    result = pd.DataFrame({'similarity': similarity},
-                          index=embedded_narratives.index)
-    result.sort_values('similarity', inplace=True, ascending=False)
-    return result
+    if filename.endswith('.jsonl'):
+        queries = pd.read_json(filename, lines=True)
+    else:
+        queries = pd.read_csv(filename)
+    if 'title' not in queries:
+        queries['title'] = title
+    if 'k' not in queries:
+        queries['k'] = k
+    queries['title'] = queries['title'].fillna(title)
+    queries['k'] = queries['k'].fillna(k).astype(int)
+    return queries[['title', 'prompt', 'k']]
 
 
 def human_readable_dollars(num: float):
@@ -252,18 +600,29 @@ def show_prompt(prompt: str):
     print(f'\033[38;5;84m\nPrompt:\033[0m {prompt}')
 
 
-def show_flags(k: int, prompt: str, output: str, title: str):
+def show_flags(k: int, prompt: str, output: str, title: str, filters=None):
     """Show the flags supplied for the SOTA Literature Search
 
     Args:
         k (int): Number of matches to return
         output (str): CSV file to store output
         title (str): Title for results if multiple queries
+        filters (dict, optional): since, categories, feeds restrictions
+            and the scope of partitions to scan
     """
 
     print('\033[38;5;84m\nSPECIFICATION: \033[0m')
     print(f"""Search for {k} most cosine-similar paper abstracts based on the "{title}" prompt:""")
     show_prompt(prompt)
+    filters = filters or {}
+    if filters.get('since'):
+        print(f' - Posted since {filters["since"]}')
+    if filters.get('categories'):
+        print(f' - In categories {", ".join(filters["categories"])}')
+    if filters.get('feeds'):
+        print(f' - From feeds {", ".join(filters["feeds"])}')
+    if filters.get('scope'):
+        print(f' - Scanning partitions {", ".join(filters["scope"])}')
     if output:
         print(f' - Results will be saved to {output}')
 
@@ -290,24 +649,314 @@ def show_data_stats(ds):
 class Experiment():
     """ Class for running
     """
-    def __init__(self, prompt: str, embeddingsFN: str, k: int):
+    def __init__(self, prompt: str, embeddingsFN: str, k: int,
+                 shard_cache_size: int = SHARD_CACHE_SIZE,
+                 search: str = 'exact', nprobe: int = ANN.NPROBE,
+                 rerank: int = ANN.RERANK, filters: dict = None,
+                 rows: tuple = None, workers: list = None,
+                 query_cache: str = None):
         self.prompt = prompt
         self.embeddingsFN = embeddingsFN
+        self.metadata = None
         self.embeddings = None
+        self.records = None
+        self.partitions = None
+        self.approximate = None
+        self.lexical = None
+        self.search = search
+        self.nprobe = nprobe
+        self.rerank = rerank
         self.nearest_neighbors = None
         self.k = k
+        self.filters = filters or {}  # since, categories, feeds, scope
+        self.rows = rows  # [start, stop) slice served as a partition worker
+        self.workers = workers  # partition workers to scatter searches to
+        self.query_cache = query_cache  # file of the CACHE.QueryCache
+        self.cache = None
+        self.masks = OrderedDict()  # LRU of filters -> INDEX.filter_mask
+        self.shard_cache_size = shard_cache_size
+        self.shards = OrderedDict()  # LRU of (source, filename) -> object
+        self.shards_lock = Lock()
+    def load(self):
+        """ Memory-map the index once; later runs reuse it
+        """
+        if self.embeddings is None:
+            self.metadata, self.embeddings = read_narrative_embeddings(self.embeddingsFN)
+            show_data_stats(self.metadata)
+            records_fn = RECORDS.records_path(self.embeddingsFN)
+            if exists(records_fn):
+                self.records = RECORDS.open_records(records_fn)
+            self.partitions = INDEX.read_partitions(self.embeddingsFN)
+        if self.query_cache and self.cache is None:
+            try:
+                self.cache = CACHE.QueryCache(
+                    self.query_cache, DRDRAFT,
+                    INDEX.index_version(self.embeddingsFN))
+            except sqlite3.Error as e:  # e.g. a read-only index directory
+                print(f'Warning: no query cache in {self.query_cache}: {e}')
+                self.query_cache = None
+        if self.search in LEXICAL_SEARCHES and self.lexical is None:
+            self.lexical = LEXICAL.read_lexical(
+                LEXICAL.lexical_path(self.embeddingsFN))
+        if self.search == 'ann' and self.approximate is None:
+            with TRACE.stage('read_ivf'):
+                self.approximate = partial(
+                    ANN.search,
+                    ANN.read_ivf(ANN.ivf_path(self.embeddingsFN),
+                                 len(self.embeddings)),
+                    self.embeddings, nprobe=self.nprobe)
+        if self.search == 'quantized' and self.approximate is None:
+            with TRACE.stage('read_quantizer'):
+                self.approximate = partial(
+                    ANN.search_quantized,
+                    ANN.read_quantizer(ANN.quantizer_path(self.embeddingsFN)),
+                    ANN.read_codes(ANN.codes_path(self.embeddingsFN),
+                                   len(self.embeddings)),
+                    self.embeddings, rerank=self.rerank)
+
+    def mask(self):
+        """ Rows allowed by the current filters, computed once per filters
+        """
+        key = tuple((name, str(self.filters[name]))
+                    for name in sorted(self.filters) if self.filters[name])
+        if key in self.masks:
+            self.masks.move_to_end(key)
+        else:
+            with TRACE.stage('filter_mask'):
+                mask = INDEX.filter_mask(self.metadata,
+                                         self.filters.get('since'),
+                                         self.filters.get('categories'),
+                                         self.filters.get('feeds'))
+                ranges = self.scope()
+                if ranges is not None and self.approximate is not None:
+                    in_scope = np.zeros(len(self.metadata), dtype=bool)
+                    for start, stop in ranges:
+                        in_scope[start:stop] = True
+                    mask = in_scope if mask is None else mask & in_scope
+            self.masks[key] = mask
+            while len(self.masks) > MASK_CACHE_SIZE:
+                self.masks.popitem(last=False)
+        return self.masks[key]
+
+    def scope(self):
+        """ Row ranges of the partitions in scope, or None to scan all
+        """
+        ranges = None
+        if self.filters.get('scope'):
+            if self.partitions is None:
+                raise ValueError('The index is not partitioned; rebuild it '
+                                 'with src/compute_embeddings.py --partition')
+            ranges = INDEX.select_partitions(self.partitions,
+                                             self.filters['scope'])
+        if self.rows is not None:  # only this worker's slice
+            ranges = INDEX.clip_ranges(ranges or [(0, len(self.metadata))],
+                                       *self.rows)
+        return ranges
+
     def run(self):
         """ Run the experiment
         """
-        self.embeddings = read_narrative_embeddings(self.embeddingsFN)
-        show_data_stats(self.embeddings)
-        self.nearest_neighbors = sort_by_similarity_to_prompt(self.prompt, self.embeddings)
+        with TRACE.stage('load'):
+            self.load()
+        with TRACE.stage('search'):
+            self.nearest_neighbors = self.search_prompts([self.prompt],
+                                                         self.k)[0]
+
+    def query(self, prompt: str, k: int, filters: dict = None):
+        """ Run a new prompt against the already loaded index
+
+        Args:
+            prompt (str): Description of the work you want to do
+            k (int): Number of matches to return
+            filters (dict, optional): since, categories, feeds restrictions
+
+        Returns:
+            pd.DataFrame: The top k results
+        """
+        self.prompt = prompt
+        self.k = k
+        self.filters = filters or {}
+        self.run()
+        return self.results()
+
+    def query_batch(self, prompts, ks):
+        """ Run many prompts against the index with one batched encode
+
+        Args:
+            prompts (List[str]): Descriptions of the work you want to do
+            ks (List[int]): Number of matches to return for each prompt
+
+        Returns:
+            List[pd.DataFrame]: The top k results for each prompt
+        """
+        with TRACE.stage('load'):
+            self.load()
+        ks = list(ks)
+        with TRACE.stage('search', prompts=len(prompts)):
+            neighbors = self.search_prompts(prompts, max(ks))
+        results = []
+        for prompt, k, nearest_neighbors in zip(prompts, ks, neighbors):
+            self.prompt = prompt
+            self.k = k
+            self.nearest_neighbors = nearest_neighbors
+            results.append(self.results())
+        return results
+
+    def search_prompts(self, prompts, k):
+        """ Top k rows for each prompt, from the query cache, here or on
+        the partition workers
+        """
+        if self.search in LEXICAL_SEARCHES and self.workers:
+            raise ValueError(f'--search {self.search} runs in one process; '
+                             f'drop --workers')
+        prompts = list(prompts)
+        keys, found = {}, {}
+        if self.cache is not None:
+            with TRACE.stage('query_cache'):
+                for i, prompt in enumerate(prompts):
+                    keys[i] = self.cache.result_key(
+                        prompt, k, search=self.search, nprobe=self.nprobe,
+                        rerank=self.rerank, filters=self.filters)
+                    hit = self.cache.get_results(keys[i])
+                    if hit is not None:
+                        found[i] = pd.DataFrame({'similarity': hit[1]},
+                                                index=hit[0])
+        todo = [i for i in range(len(prompts)) if i not in found]
+        if todo:
+            missing = [prompts[i] for i in todo]
+            hits = self.search_encoded(missing, self.encode(missing), k)
+            for i, ranking in zip(todo, hits):
+                found[i] = ranking
+                if self.cache is not None:
+                    self.cache.put_results(keys[i], ranking.index,
+                                           ranking.similarity)
+        return [found[i] for i in range(len(prompts))]
+
+    def encode(self, prompts):
+        """ Normalized prompt vectors, encoding only the uncached prompts
+        """
+        if self.cache is None:
+            return INDEX.normalize(
+                np.asarray(encode_prompts(prompts), dtype=np.float32))
+        vectors = [self.cache.get_vector(prompt) for prompt in prompts]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            encoded = INDEX.normalize(np.asarray(
+                encode_prompts([prompts[i] for i in missing]),
+                dtype=np.float32))
+            for i, vector in zip(missing, encoded):
+                vectors[i] = vector
+                self.cache.put_vector(prompts[i], vector)
+        return np.stack(vectors)
+
+    def search_encoded(self, prompts, vectors, k):
+        """ Top k rows for prompts and their normalized vectors
+        """
+        if self.search in LEXICAL_SEARCHES:
+            return sort_by_lexical(prompts, vectors, self.lexical,
+                                   self.embeddings, k, self.search,
+                                   self.mask(), self.scope())
+        if self.workers:
+            with TRACE.stage('scatter', workers=len(self.workers)):
+                hits = SERVER.scatter(self.workers, vectors, k, self.filters,
+                                      self.search, self.nprobe, self.rerank)
+            return gather(hits, k)
+        return sort_by_similarity_to_vectors(vectors, self.embeddings, k,
+                                             self.approximate, self.mask(),
+                                             self.scope())
+
+    def search_vectors(self, vectors, k: int, filters: dict = None,
+                       search: str = 'exact', nprobe: int = None,
+                       rerank: int = None):
+        """ Top k rows for encoded prompts, as a partition worker
+
+        Args:
+            vectors (List[List[float]]): Normalized prompt vectors
+            k (int): Number of candidates per prompt
+            filters (dict, optional): since, categories, feeds, scope
+            search (str, optional): exact, ann or quantized, as asked by
+                the coordinator. Defaults to 'exact'.
+            nprobe (int, optional): IVF lists probed. Defaults to ours.
+            rerank (int, optional): Quantized shortlist. Defaults to ours.
+
+        Returns:
+            List[pd.DataFrame]: Similarity of the top k rows of this
+                worker's slice for each prompt, indexed by row
+        """
+        if search in LEXICAL_SEARCHES:
+            raise ValueError(f'--search {search} runs in one process')
+        mode = (search, nprobe or self.nprobe, rerank or self.rerank)
+        if mode != (self.search, self.nprobe, self.rerank):
+            self.search, self.nprobe, self.rerank = mode
+            self.approximate = None  # reloaded for the new mode
+            self.masks.clear()  # an approximate search masks the scope
+        self.filters = filters or {}
+        self.load()
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(
+            -1, self.embeddings.shape[1])
+        return sort_by_similarity_to_vectors(vectors, self.embeddings, k,
+                                             self.approximate, self.mask(),
+                                             self.scope())
+
+    def results(self):
+        """ Top k results of the last run
+
+        Duplicates were folded into one entry at index build, so the
+        top k are k distinct papers (with their Alternates).
+        """
+        return self.select_results(range(self.k))
 
     def select_results(self, neighbors):
-        df = pd.DataFrame([self.read_neighbor(i) for i in neighbors])
-        df['CloseDate'] = pd.to_datetime(df['CloseDate'])
+        neighbors = [i for i in neighbors if i < len(self.nearest_neighbors)]
+        with TRACE.stage('select_results', k=len(neighbors)):
+            if self.records is not None:
+                rows = self.read_records(neighbors)
+            else:  # index built before records.sqlite existed
+                rows = self.read_neighbors(neighbors)
+            df = pd.DataFrame(rows, columns=DATA.ATTRIBUTES)  # even if no match
+            df['CloseDate'] = pd.to_datetime(df['CloseDate'], errors='coerce',
+                                             format=DATA.MMDDYYYY)
         return df
 
+    def read_records(self, neighbors):
+        ids = self.nearest_neighbors.index[neighbors]
+        similarity = self.nearest_neighbors.similarity.iloc[neighbors]
+        with TRACE.stage('read_records'):
+            return [{'Similarity': s, **record} for s, record
+                    in zip(similarity,
+                           RECORDS.read_records(self.records, ids))]
+
+    def read_neighbors(self, neighbors):
+        """ Hydrate neighbors from raw shards, parsing each shard once
+
+        Distinct shards are loaded concurrently; records come back in
+        the order of neighbors.
+        """
+        rows = self.metadata.loc[self.nearest_neighbors.index[neighbors]]
+        similarity = self.nearest_neighbors.similarity.iloc[neighbors]
+        keys = list(dict.fromkeys(zip(rows.source, rows.filename)))
+        with ThreadPoolExecutor(HYDRATION_WORKERS) as pool:
+            shards = dict(zip(keys, pool.map(lambda x: self.load_shard(*x),
+                                             keys)))
+        return [shards[(x.source, x.filename)].to_dict(x.row, s)
+                for x, s in zip(rows.itertuples(), similarity)]
+
     def read_neighbor(self, i):
-        x=self.embeddings.loc[self.nearest_neighbors.index[i]]
-        return getattr(DATA,x.source)(x.filename,TARGET[x.source]).to_dict(x.row,self.nearest_neighbors.iloc[i].similarity)
+        x=self.metadata.loc[self.nearest_neighbors.index[i]]
+        return self.load_shard(x.source, x.filename).to_dict(x.row,self.nearest_neighbors.iloc[i].similarity)
+
+    def load_shard(self, source: str, filename: str):
+        """ Parsed raw shard from the LRU, reading it on a miss
+        """
+        key = (source, filename)
+        with self.shards_lock:
+            if key in self.shards:
+                self.shards.move_to_end(key)
+                return self.shards[key]
+        with TRACE.stage('parse_shard', filename=filename):
+            shard = getattr(DATA, source)(filename, TARGET[source])
+        with self.shards_lock:
+            self.shards[key] = shard
+            while len(self.shards) > self.shard_cache_size:
+                self.shards.popitem(last=False)
+        return shard
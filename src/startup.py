@@ -0,0 +1,62 @@
+"""
+Summarized import-time report for `main.py --timing-startup`
+
+Like `python -X importtime`, but instead of one line per module it adds up
+the self time of every import under its top-level package and prints the
+slowest packages when the process exits.
+"""
+import builtins
+from time import perf_counter
+
+SHOW_PACKAGES = 12
+
+
+class ImportTimer():
+    """ Time every import statement by wrapping builtins.__import__
+    """
+    def __init__(self):
+        self.start = perf_counter()
+        self.self_times = {}
+        self._children = []
+        self._import = None
+
+    def install(self):
+        self._import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def uninstall(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(),
+                      level=0):
+        if level and globals:
+            package = globals.get('__package__') or name
+        else:
+            package = name
+        package = package.split('.')[0]
+        self._children.append(0.0)
+        tic = perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = perf_counter() - tic
+            children = self._children.pop()
+            self.self_times[package] = self.self_times.get(package, 0.0) \
+                + elapsed - children
+            if self._children:
+                self._children[-1] += elapsed
+
+    def report(self):
+        """ Print total import time and the slowest top-level packages
+        """
+        self.uninstall()
+        total = sum(self.self_times.values())
+        wall = perf_counter() - self.start
+        print(f'\033[38;5;84m\nSTARTUP: \033[0m{total:.3f}s importing '
+              f'of {wall:.3f}s since --timing-startup')
+        slowest = sorted(self.self_times.items(), key=lambda x: -x[1])
+        for package, seconds in slowest[:SHOW_PACKAGES]:
+            share = 100*seconds/total if total else 0
+            print(f' - {package:<24} {1000*seconds:9.1f} ms  {share:5.1f}%')
@@ -0,0 +1,157 @@
+"""
+Per-stage wall time, CPU time and peak RSS for `--profile`
+
+Code wraps each stage of a search or an index build in `stage(name)`.
+When profiling is off (the default) a stage costs one attribute check.
+When it is on, every stage records its wall time, the CPU time of the
+process (all threads, including BLAS) and the peak resident set size at
+its end. At exit the stages are summarized on the console and written as
+a JSON trace and, optionally, a Chrome trace (chrome://tracing or
+https://ui.perfetto.dev).
+"""
+import atexit
+import json
+import resource
+import threading
+from collections import deque
+from contextlib import contextmanager
+from os import getpid
+from time import perf_counter, process_time, strftime
+
+MAX_EVENTS = 100000  # a --serve process keeps only the latest stages
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far (Linux: KiB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+
+class Tracer():
+    """ Nested stages of this process, with per-name totals
+    """
+    def __init__(self):
+        self.enabled = False
+        self.start = perf_counter()
+        self.events = deque(maxlen=MAX_EVENTS)
+        self.totals = {}  # name -> count, wall, cpu, peak_rss_mb
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        self.start = perf_counter()
+
+    @contextmanager
+    def stage(self, name: str, **args):
+        """ Time the body of a with block as one stage
+
+        Args:
+            name (str): Stage name; repeated stages are totalled by name
+            **args: Details kept with the event, e.g. the shard file
+        """
+        if not self.enabled:
+            yield
+            return
+        parents = getattr(self._local, 'stack', None)
+        if parents is None:
+            parents = self._local.stack = []
+        parents.append(name)
+        rss = peak_rss_mb()
+        cpu = process_time()
+        tic = perf_counter()
+        try:
+            yield
+        finally:
+            wall = perf_counter() - tic
+            cpu = process_time() - cpu
+            peak = peak_rss_mb()
+            parents.pop()
+            event = {'name': name, 'parent': parents[-1] if parents else None,
+                     'start': tic - self.start, 'wall': wall, 'cpu': cpu,
+                     'peak_rss_mb': peak, 'rss_growth_mb': peak - rss,
+                     'thread': threading.get_ident(), **args}
+            with self._lock:
+                self.events.append(event)
+                total = self.totals.setdefault(
+                    name, {'count': 0, 'wall': 0.0, 'cpu': 0.0,
+                           'peak_rss_mb': 0.0})
+                total['count'] += 1
+                total['wall'] += wall
+                total['cpu'] += cpu
+                total['peak_rss_mb'] = max(total['peak_rss_mb'], peak)
+
+    def report(self):
+        """ Print the time, CPU and peak RSS of every stage name
+        """
+        print(f'\033[38;5;84m\nPROFILE: \033[0m'
+              f'{perf_counter() - self.start:.3f}s wall, '
+              f'{process_time():.3f}s CPU, peak RSS {peak_rss_mb():.0f} MiB')
+        print(f'   {"stage":<28} {"calls":>6} {"wall s":>9} {"cpu s":>9} '
+              f'{"peak MiB":>9}')
+        with self._lock:
+            totals = sorted(self.totals.items(), key=lambda x: -x[1]['wall'])
+        for name, total in totals:
+            print(f' - {name:<28} {total["count"]:6d} {total["wall"]:9.3f} '
+                  f'{total["cpu"]:9.3f} {total["peak_rss_mb"]:9.0f}')
+
+    def write(self, filename: str):
+        """ Write the stages and their totals as JSON
+
+        Args:
+            filename (str): Destination file
+        """
+        with self._lock:
+            trace = {'date': strftime('%Y-%m-%d %H:%M:%S'), 'pid': getpid(),
+                     'wall': perf_counter() - self.start,
+                     'cpu': process_time(), 'peak_rss_mb': peak_rss_mb(),
+                     'totals': dict(self.totals), 'stages': list(self.events)}
+        with open(filename, 'w') as f:
+            json.dump(trace, f, indent=1, default=str)
+
+    def write_chrome(self, filename: str):
+        """ Write the stages in the Chrome trace event format
+
+        Args:
+            filename (str): Destination file, e.g. trace.json
+        """
+        pid = getpid()
+        with self._lock:
+            events = [{'name': e['name'], 'ph': 'X', 'pid': pid,
+                       'tid': e['thread'], 'ts': 1e6*e['start'],
+                       'dur': 1e6*e['wall'],
+                       'args': {k: v for k, v in e.items()
+                                if k not in ('name', 'start', 'wall',
+                                             'thread')}}
+                      for e in self.events]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f,
+                      default=str)
+
+
+TRACER = Tracer()
+
+
+def stage(name: str, **args):
+    """ `with stage('encode'):` on the process-wide tracer
+    """
+    return TRACER.stage(name, **args)
+
+
+def profile(filename: str = None, chrome: str = None):
+    """ Start tracing; report and write the trace files at exit
+
+    Args:
+        filename (str, optional): JSON trace. Defaults to none.
+        chrome (str, optional): Chrome trace. Defaults to none.
+    """
+    TRACER.enable()
+
+    def finish():
+        TRACER.report()
+        if filename:
+            TRACER.write(filename)
+            print(f' - Trace written to {filename}')
+        if chrome:
+            TRACER.write_chrome(chrome)
+            print(f' - Chrome trace written to {chrome}')
+    atexit.register(finish)